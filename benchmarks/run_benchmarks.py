@@ -0,0 +1,172 @@
+import os
+import os.path as osp
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+REPO_DIR = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, osp.join(REPO_DIR, "src"))
+sys.path.insert(0, osp.dirname(osp.abspath(__file__)))
+
+import SQUIDp.process as pp
+from synthetic import make_slide
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _best_of(fn, repeat):
+    """
+    Runs fn repeat times, returns (fastest wall time, last result).
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_slide(n_cells, patch_size=224, repeat=3, slow=True, n_genes=460):
+    """
+    Times each pipeline step on one synthetic slide, returns {benchmark name: seconds}.
+    The per-patch reader and per-patch aggregation are the reference paths;
+    slow=False skips them.
+    """
+    st = make_slide(n_cells, n_genes=n_genes)
+    sdata, wsi = st.to_spatial_data(), st.wsi
+    timings = dict()
+
+    timings['get_cell_ids_in_patch'], patch_bins = _best_of(
+        lambda: pp.get_cell_ids_in_patch(sdata, patch_size=patch_size), repeat)
+
+    timings['match_patch_id_to_PIL[tiled]'], patch_id_to_pil = _best_of(
+        lambda: pp.match_patch_id_to_PIL(sdata, wsi, patch_bins, patch_size=patch_size, reader='tiled'), repeat)
+    if slow:
+        timings['match_patch_id_to_PIL[patch]'], _ = _best_of(
+            lambda: pp.match_patch_id_to_PIL(sdata, wsi, patch_bins, patch_size=patch_size, reader='patch'), repeat)
+
+    timings['match_patch_id_to_expr[sparse]'], (kept_bins, kept_pil, patch_id_to_expr) = _best_of(
+        lambda: pp.match_patch_id_to_expr(sdata, patch_bins, dict(patch_id_to_pil), agg_mode='sparse'), repeat)
+    if slow:
+        timings['match_patch_id_to_expr[subset]'], _ = _best_of(
+            lambda: pp.match_patch_id_to_expr(sdata, patch_bins, dict(patch_id_to_pil), agg_mode='subset'), repeat)
+
+    output_dir = tempfile.mkdtemp(prefix="squidp_bench_")
+    try:
+        for output_format in ['npy', 'pkl']:
+            timings[f'save_patches[{output_format}]'], _ = _best_of(
+                lambda: pp.save_patches(sdata, st.meta['id'], kept_bins, kept_pil, patch_id_to_expr, output_dir,
+                                        output_format=output_format, patch_size=patch_size), repeat)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    return timings, {'n_patches': int(kept_bins.n_patches), 'wsi_px': [wsi.width, wsi.height]}
+
+# modules and commands whose startup cost is tracked
+IMPORT_MODULES = ['SQUIDp.process', 'SQUIDp.download', 'SQUIDp.embed', 'SQUIDp.evaluate', 'SQUIDp.data']
+HELP_COMMANDS = ['SQUIDp.process', 'SQUIDp.download', 'SQUIDp.embed', 'SQUIDp.evaluate']
+
+def _import_seconds(module):
+    """
+    Cumulative import time of module in a fresh interpreter, from -X importtime.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([osp.join(REPO_DIR, "src"), os.environ.get('PYTHONPATH', '')]))
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], env=env,
+                            capture_output=True, text=True, check=True).stderr
+    for line in stderr.splitlines()[::-1]:
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    raise RuntimeError(f"no import time reported for {module}")
+
+def _help_seconds(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([osp.join(REPO_DIR, "src"), os.environ.get('PYTHONPATH', '')]))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', module, '--help'], env=env, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+def bench_imports(repeat=3):
+    """
+    Import time of each entry point module and wall time of its --help, each
+    in a fresh interpreter, returns {benchmark name: seconds}.
+    """
+    timings = dict()
+    for module in IMPORT_MODULES:
+        timings[f'import[{module}]'] = min(_import_seconds(module) for _ in range(repeat))
+    for module in HELP_COMMANDS:
+        timings[f'help[{module}]'] = min(_help_seconds(module) for _ in range(repeat))
+    return timings
+
+def load_results(results_file):
+    if not osp.exists(results_file):
+        return []
+    with open(results_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(records, previous):
+    """
+    Prints each benchmark of this run next to the latest result of another
+    commit at the same scale.
+    """
+    baseline = dict()
+    for record in previous:
+        baseline[(record['n_cells'], record['patch_size'], record['name'])] = record
+    print(f"{'n_cells':>9} {'benchmark':<34} {'seconds':>9} {'baseline':>9} {'ratio':>7}")
+    for record in records:
+        base = baseline.get((record['n_cells'], record['patch_size'], record['name']))
+        if base is None:
+            print(f"{record['n_cells']:>9} {record['name']:<34} {record['seconds']:>9.3f}")
+            continue
+        ratio = record['seconds'] / base['seconds'] if base['seconds'] > 0 else float('nan')
+        flag = "  <- slower" if ratio > 1.2 else ""
+        print(f"{record['n_cells']:>9} {record['name']:<34} {record['seconds']:>9.3f} {base['seconds']:>9.3f} "
+              f"{ratio:>6.2f}x ({base['commit']}){flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the patch pipeline on synthetic HEST-like slides")
+    parser.add_argument('--suites', type=str, nargs='+', default=['pipeline', 'imports'], choices=['pipeline', 'imports'],
+                        help="Pipeline steps on synthetic slides, and the startup time of the entry points")
+    parser.add_argument('--n_cells', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="Number of cells of each synthetic slide")
+    parser.add_argument('--patch_size', type=int, default=224)
+    parser.add_argument('--n_genes', type=int, default=460)
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, the fastest is recorded")
+    parser.add_argument('--skip_slow', action='store_true',
+                        help="Skip the per-patch reader and per-patch aggregation reference paths")
+    parser.add_argument('--results_file', type=str, default=osp.join(REPO_DIR, "benchmarks", "results.jsonl"),
+                        help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    commit = _git_commit()
+    previous = [record for record in load_results(args.results_file) if record.get('commit') != commit]
+    run = {'commit': commit, 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+           'host': platform.node(), 'python': platform.python_version(), 'cpus': os.cpu_count()}
+
+    records = []
+    if 'imports' in args.suites:
+        for name, seconds in bench_imports(repeat=args.repeat).items():
+            records.append(dict(run, n_cells=0, patch_size=None, name=name, seconds=round(seconds, 5)))
+    for n_cells in args.n_cells if 'pipeline' in args.suites else []:
+        timings, info = bench_slide(n_cells, patch_size=args.patch_size, repeat=args.repeat,
+                                    slow=not args.skip_slow, n_genes=args.n_genes)
+        for name, seconds in timings.items():
+            records.append(dict(run, n_cells=n_cells, patch_size=args.patch_size, n_genes=args.n_genes,
+                                name=name, seconds=round(seconds, 5), **info))
+
+    os.makedirs(osp.dirname(osp.abspath(args.results_file)), exist_ok=True)
+    with open(args.results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    compare(records, previous)
+
+if __name__ == "__main__":
+    main()
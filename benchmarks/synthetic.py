@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from types import SimpleNamespace
+
+GLASS = (235, 232, 238)
+EOSIN = (232, 150, 200)
+HAEMATOXYLIN = (110, 60, 160)
+
+class SyntheticWSI:
+    """
+    Stand-in for the WSI handle of a HEST slide (width, height, read_region,
+    get_thumbnail). Pixels come from a random H&E-like texture tiled over an
+    elliptical tissue region on glass, so slides far larger than memory can be
+    read region by region. The texture size is
+    reported as the native tile size, like an openslide pyramidal TIFF.
+    """
+    def __init__(self, width, height, tile_size=512, seed=0):
+        self.width = int(width)
+        self.height = int(height)
+        # smooth blobs between eosin pink and haematoxylin purple with a little pixel noise
+        rng = np.random.default_rng(seed)
+        n_blobs = -(-tile_size // 32)
+        blobs = np.kron(rng.uniform(0, 1, (n_blobs, n_blobs)), np.ones((32, 32)))[:tile_size, :tile_size, None]
+        colors = (1 - blobs) * np.array(EOSIN) + blobs * np.array(HAEMATOXYLIN)
+        self.texture = np.clip(colors + rng.normal(0, 8, colors.shape), 0, 255).astype(np.uint8)
+        self.img = SimpleNamespace(properties={
+            'openslide.level[0].tile-width': str(tile_size),
+            'openslide.level[0].tile-height': str(tile_size),
+        })
+
+    def _render(self, ys, xs):
+        region = self.texture[(ys % len(self.texture))[:, None], (xs % len(self.texture))[None, :]]
+        # bright grey glass outside the tissue ellipse inscribed in the slide
+        ry, rx = self.height / 2, self.width / 2
+        glass = ((ys[:, None] - ry) / ry) ** 2 + ((xs[None, :] - rx) / rx) ** 2 > 1
+        if glass.any():
+            region = region.copy()
+            region[glass] = GLASS
+        return region
+
+    def read_region(self, location, level, size):
+        x, y = location
+        w, h = size
+        return self._render(np.arange(y, y + h), np.arange(x, x + w))
+
+    def get_thumbnail(self, width, height):
+        ys = (np.arange(height) * self.height) // height
+        xs = (np.arange(width) * self.width) // width
+        return self._render(ys, xs)
+
+def make_slide(n_cells, n_genes=460, cell_spacing=40, density=0.05, missing_frac=0.01, tile_size=512, seed=0):
+    """
+    A HEST-like slide with n_cells centroids scattered over an elliptical
+    tissue region of a WSI sized for roughly cell_spacing pixels between
+    cells, and a sparse cells x genes AnnData table. A missing_frac of the
+    cells has no row in the table, as with real segmentations.
+
+    Returns an object with .meta, .wsi and to_spatial_data(), like the
+    HESTData objects iter_hest yields.
+    """
+    import anndata as ad
+    import geopandas as gpd
+
+    rng = np.random.default_rng(seed)
+    side = int(np.sqrt(n_cells * 4 / np.pi) * cell_spacing) + 2 * cell_spacing
+    wsi = SyntheticWSI(side, side, tile_size=tile_size, seed=seed)
+
+    # uniform points in the ellipse inscribed in the slide
+    radius = np.sqrt(rng.uniform(0, 1, n_cells)) * (side / 2 - cell_spacing)
+    angle = rng.uniform(0, 2 * np.pi, n_cells)
+    x = side / 2 + radius * np.cos(angle)
+    y = side / 2 + radius * np.sin(angle)
+
+    cell_ids = np.arange(n_cells)
+    locations = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), index=pd.Index(cell_ids))
+
+    in_table = np.sort(rng.choice(n_cells, int(n_cells * (1 - missing_frac)), replace=False))
+    X = sp.random(len(in_table), n_genes, density=density, format='csr', dtype=np.float32, random_state=seed)
+    X.data = np.ceil(X.data * 10)
+    table = ad.AnnData(X=X, obs=pd.DataFrame({'instance_id': cell_ids[in_table]}, index=in_table.astype(str)),
+                       var=pd.DataFrame(index=[f"gene_{i}" for i in range(n_genes)]))
+
+    sdata = {'locations': locations, 'table': table}
+    return SimpleNamespace(meta={'id': f"SYN{n_cells}"}, wsi=wsi, to_spatial_data=lambda: sdata)
@@ -8,4 +8,15 @@ setup(
     install_requires=[
         'hest @ git+https://github.com/MahmoodLab/HEST.git@main',  # use specific commit or tag if needed
     ],
-)
\ No newline at end of file
+    entry_points={
+        'console_scripts': [
+            'squidp-download=SQUIDp.download:main',
+            'squidp-process=SQUIDp.process:main',
+            'squidp-embed=SQUIDp.embed:main',
+            'squidp-evaluate=SQUIDp.evaluate:main',
+            'squidp-qc=SQUIDp.qc:main',
+            'squidp-meta=SQUIDp.meta:main',
+            'squidp-convert=SQUIDp.data.bundle:main',
+        ],
+    },
+)
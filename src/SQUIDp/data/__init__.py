@@ -1 +1,10 @@
-from ....data.patch_process import *
\ No newline at end of file
+from .bundle import PatchBundle, PatchBundleWriter, EncodedImages, write_bundle, load_bundle, is_bundle, find_bundles, find_processed_bundles, read_meta, convert_pickle
+
+# the torch dataset is only imported when asked for, so bundle tools don't pay for torch
+_LAZY = {'PatchBundleDataset': '.dataset', 'make_loader': '.dataset'}
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        return getattr(importlib.import_module(_LAZY[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
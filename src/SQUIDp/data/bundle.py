@@ -0,0 +1,309 @@
+import io
+import os
+import os.path as osp
+import json
+import shutil
+import pickle
+import argparse
+import numpy as np
+from typing import NamedTuple, Optional
+
+# version 2 added encoded images, raw bundles are still written as version 1
+FORMAT_VERSION = 2
+META_NAME = "meta.json"
+
+# one file per column, each can be opened with np.load(mmap_mode='r')
+IMAGES = "images.npy"      # (N, H, W, 3) uint8
+IMAGES_BIN = "images.bin"  # encoded images back to back, instead of images.npy when encoded
+IMAGE_OFFSETS = "image_offsets.npy"  # (N + 1,) int64, image i is images.bin[offsets[i]:offsets[i + 1]]
+EXPR = "expr.npy"          # (N, G) float32, average expression of the cells in the patch
+COORDS = "coords.npy"      # (N, 2) int64, (y_patch_idx, x_patch_idx)
+N_CELLS = "n_cells.npy"    # (N,) int32, -1 when unknown
+GENES = "genes.npy"        # (G,) unicode
+
+IMAGE_ENCODINGS = {'raw': None, 'jpeg': 'JPEG', 'webp': 'WEBP', 'png': 'PNG'}
+
+def encode_image(image, encoding='jpeg', quality=90) -> bytes:
+    """
+    Encodes one (H, W, 3) image; quality applies to jpeg and webp, png is lossless.
+    """
+    from PIL import Image
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.ascontiguousarray(np.asarray(image)[..., :3], dtype=np.uint8))
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    if encoding == 'png':
+        image.save(buffer, format='PNG', compress_level=6)
+    else:
+        image.save(buffer, format=IMAGE_ENCODINGS[encoding], quality=int(quality))
+    return buffer.getvalue()
+
+def decode_image(data) -> np.ndarray:
+    from PIL import Image
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+class EncodedImages:
+    """
+    Array-like view of the encoded images of a bundle: indexing with an int,
+    slice or index array decodes just those images into (..., H, W, 3) uint8.
+    """
+    def __init__(self, data, offsets, patch_size):
+        self.data = data
+        self.offsets = offsets
+        self.patch_size = patch_size
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def shape(self):
+        return (len(self), self.patch_size, self.patch_size, 3)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.uint8)
+
+    def _decode(self, i):
+        return decode_image(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f"index {idx} out of range for {len(self)} images")
+            return self._decode(int(idx))
+        rows = np.arange(len(self))[idx]
+        out = np.empty((len(rows), self.patch_size, self.patch_size, 3), dtype=np.uint8)
+        for j, i in enumerate(rows.tolist()):
+            out[j] = self._decode(i)
+        return out
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._decode(i)
+
+class PatchBundle(NamedTuple):
+    """
+    A processed slide, every column memory-mapped unless loaded with mmap=False.
+    Encoded images are an EncodedImages that decodes on indexing.
+    """
+    images: np.ndarray
+    expr: np.ndarray
+    coords: np.ndarray
+    n_cells: np.ndarray
+    genes: np.ndarray
+    meta: dict
+
+    def __len__(self):
+        return len(self.expr)
+
+class PatchBundleWriter:
+    """
+    Writes a bundle patch by patch into preallocated memory-mapped files.
+
+    Everything goes to a temporary directory that is moved into place by
+    close(), and meta.json is written last, so a bundle is either complete or
+    absent.
+
+    With an image encoding other than 'raw', images are compressed one by one
+    into images.bin, and batches have to be written in order.
+    """
+    def __init__(self, path, n_patches, patch_size, gene_names, image_encoding='raw', image_quality=90, **meta):
+        if image_encoding not in IMAGE_ENCODINGS:
+            raise ValueError(f"Unknown image encoding: {image_encoding}")
+        self.path = path
+        self.tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+        n_genes = len(gene_names)
+        self.image_encoding = image_encoding
+        self.image_quality = image_quality
+        self.meta = dict(meta, format_version=1 if image_encoding == 'raw' else FORMAT_VERSION,
+                         n_patches=int(n_patches), patch_size=int(patch_size), n_genes=n_genes,
+                         image_encoding=image_encoding)
+        if image_encoding == 'raw':
+            self.images = np.lib.format.open_memmap(osp.join(self.tmp_path, IMAGES), mode='w+', dtype=np.uint8,
+                                                    shape=(n_patches, patch_size, patch_size, 3))
+        else:
+            self.meta['image_quality'] = int(image_quality)
+            self.images = open(osp.join(self.tmp_path, IMAGES_BIN), 'wb')
+            self.image_offsets = np.zeros(n_patches + 1, dtype=np.int64)
+            self.next_row = 0
+        self.expr = np.lib.format.open_memmap(osp.join(self.tmp_path, EXPR), mode='w+', dtype=np.float32,
+                                              shape=(n_patches, n_genes))
+        self.coords = np.zeros((n_patches, 2), dtype=np.int64)
+        self.n_cells = np.full(n_patches, -1, dtype=np.int32)
+        self.genes = np.asarray(gene_names, dtype=str)
+
+    def write(self, start, images, expr, coords, n_cells=None):
+        """
+        Writes a batch of patches at rows [start, start + len(images)).
+        """
+        stop = start + len(images)
+        if self.image_encoding == 'raw':
+            for i, image in enumerate(images):
+                self.images[start + i] = np.asarray(image)[..., :3]
+        else:
+            if start != self.next_row:
+                raise ValueError(f"Encoded bundles are written in order, expected row {self.next_row}, got {start}")
+            for i, image in enumerate(images):
+                data = encode_image(image, self.image_encoding, self.image_quality)
+                self.images.write(data)
+                self.image_offsets[start + i + 1] = self.image_offsets[start + i] + len(data)
+            self.next_row = stop
+        self.expr[start:stop] = expr
+        self.coords[start:stop] = coords
+        if n_cells is not None:
+            self.n_cells[start:stop] = n_cells
+
+    def flush(self):
+        self.images.flush()
+        self.expr.flush()
+
+    def close(self):
+        self.flush()
+        if self.image_encoding == 'raw':
+            del self.images
+        else:
+            if self.next_row != len(self.image_offsets) - 1:
+                raise ValueError(f"Only {self.next_row} of {len(self.image_offsets) - 1} encoded images were written")
+            self.images.close()
+            np.save(osp.join(self.tmp_path, IMAGE_OFFSETS), self.image_offsets)
+        del self.expr
+        np.save(osp.join(self.tmp_path, COORDS), self.coords)
+        np.save(osp.join(self.tmp_path, N_CELLS), self.n_cells)
+        np.save(osp.join(self.tmp_path, GENES), self.genes)
+        with open(osp.join(self.tmp_path, META_NAME), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+        if osp.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.image_encoding != 'raw':
+            self.images.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_bundle(path, images, expr, coords, gene_names, n_cells=None, patch_size=None, image_encoding='raw',
+                 image_quality=90, **meta):
+    """
+    Writes a whole slide at once, images is any sequence of (H, W, 3) arrays or PIL images.
+    """
+    if patch_size is None:
+        patch_size = np.asarray(images[0]).shape[0] if len(images) else 0
+    with PatchBundleWriter(path, len(images), patch_size, gene_names, image_encoding=image_encoding,
+                           image_quality=image_quality, **meta) as writer:
+        writer.write(0, images, expr, coords, n_cells)
+
+def is_bundle(path):
+    return osp.exists(osp.join(path, META_NAME))
+
+def find_bundles(root):
+    """
+    Returns every complete bundle directly under root, sorted by name.
+    """
+    return sorted(osp.join(root, name) for name in os.listdir(root) if is_bundle(osp.join(root, name)))
+
+def find_processed_bundles(root):
+    """
+    Returns every bundle of a squidp-process output directory: those directly
+    under root, then those of a multi-scale run under its patch_<size> folders.
+    """
+    bundle_paths = find_bundles(root)
+    for name in sorted(os.listdir(root)):
+        size_dir = osp.join(root, name)
+        if name.startswith("patch_") and osp.isdir(size_dir) and not is_bundle(size_dir):
+            bundle_paths += find_bundles(size_dir)
+    return bundle_paths
+
+def read_meta(path):
+    with open(osp.join(path, META_NAME), 'r') as f:
+        return json.load(f)
+
+def load_bundle(path, mmap=True) -> PatchBundle:
+    """
+    Opens a bundle; with mmap=True nothing but meta.json is read until the
+    arrays are sliced, so arbitrary patch subsets can be read zero-copy.
+    """
+    meta = read_meta(path)
+    if meta.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} has bundle format {meta['format_version']}, newer than supported {FORMAT_VERSION}")
+
+    mmap_mode = 'r' if mmap else None
+    if meta.get('image_encoding', 'raw') == 'raw':
+        images = np.load(osp.join(path, IMAGES), mmap_mode=mmap_mode)
+    else:
+        images_bin = osp.join(path, IMAGES_BIN)
+        if not mmap:
+            data = np.fromfile(images_bin, dtype=np.uint8)
+        elif osp.getsize(images_bin) == 0:
+            data = np.empty(0, dtype=np.uint8)
+        else:
+            data = np.memmap(images_bin, dtype=np.uint8, mode='r')
+        images = EncodedImages(data, np.load(osp.join(path, IMAGE_OFFSETS)), meta['patch_size'])
+    return PatchBundle(
+        images=images,
+        expr=np.load(osp.join(path, EXPR), mmap_mode=mmap_mode),
+        coords=np.load(osp.join(path, COORDS), mmap_mode=mmap_mode),
+        n_cells=np.load(osp.join(path, N_CELLS), mmap_mode=mmap_mode),
+        genes=np.load(osp.join(path, GENES)),
+        meta=meta,
+    )
+
+def convert_pickle(pkl_path, out_path=None, gene_names: Optional[list] = None, image_encoding='raw', image_quality=90):
+    """
+    Converts a patch_to_expr_<id>.pkl written by save_patches into a bundle
+    next to it. Cell counts were never pickled, so they are stored as -1.
+    """
+    if out_path is None:
+        out_path = osp.splitext(pkl_path)[0]
+    with open(pkl_path, 'rb') as f:
+        data = pickle.load(f)
+
+    n_genes = len(data[0]['expr']) if data else len(gene_names or [])
+    if gene_names is None:
+        gene_names = [f"gene_{i}" for i in range(n_genes)]
+    sample_id = osp.basename(out_path)
+    if sample_id.startswith('patch_to_expr_'):
+        sample_id = sample_id[len('patch_to_expr_'):]
+
+    images = [d['pil'] for d in data]
+    expr = np.asarray([d['expr'] for d in data], dtype=np.float32).reshape(len(data), n_genes)
+    coords = np.asarray([d['patch_id'] for d in data], dtype=np.int64).reshape(len(data), 2)
+    write_bundle(out_path, images, expr, coords, gene_names, image_encoding=image_encoding,
+                 image_quality=image_quality, id=sample_id)
+    return out_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled patch files into memory-mappable bundles")
+    parser.add_argument('pkl_paths', type=str, nargs='+', help="patch_to_expr_<id>.pkl files to convert")
+    parser.add_argument('--genes', type=str, default=None, help="Text file with one gene name per line")
+    parser.add_argument('--image_encoding', type=str, default='raw', choices=list(IMAGE_ENCODINGS),
+                        help="Store images as a raw uint8 array or compressed one by one")
+    parser.add_argument('--image_quality', type=int, default=90, help="Quality of jpeg and webp images")
+    args = parser.parse_args()
+
+    gene_names = None
+    if args.genes is not None:
+        with open(args.genes, 'r') as f:
+            gene_names = [line.strip() for line in f if line.strip()]
+    for pkl_path in args.pkl_paths:
+        out_path = convert_pickle(pkl_path, gene_names=gene_names, image_encoding=args.image_encoding,
+                                  image_quality=args.image_quality)
+        print(f"Converted {pkl_path} -> {out_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import torch
+from collections import OrderedDict
+from torch.utils.data import Dataset, DataLoader
+from .bundle import load_bundle, read_meta
+
+class PatchBundleDataset(Dataset):
+    """
+    Indexes the patches of many processed slides (see SQUIDp.data.bundle)
+    without loading them. Only meta.json is read up front; each worker opens
+    the memory-mapped arrays of a slide the first time it needs them and keeps
+    at most max_open slides open.
+
+    Items are {'image': (3, H, W) uint8, 'expr': (G,) float32, 'slide': int,
+    'index': int}, so the default collate yields batched uint8 tensors that a
+    foundation model transform can normalize on the GPU.
+    """
+    def __init__(self, bundle_paths, transform=None, return_expr=True, max_open=16):
+        self.bundle_paths = list(bundle_paths)
+        self.transform = transform
+        self.return_expr = return_expr
+        self.max_open = max_open
+
+        self.metas = [read_meta(path) for path in self.bundle_paths]
+        lengths = np.array([meta['n_patches'] for meta in self.metas], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        # per-process cache of open bundles, rebuilt in every DataLoader worker
+        self._pid = None
+        self._open = OrderedDict()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    # global index -> (slide, row within that slide)
+    def locate(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        if np.any((idx < 0) | (idx >= len(self))):
+            raise IndexError(f"index out of range for {len(self)} patches")
+        slide = np.searchsorted(self.offsets, idx, side='right') - 1
+        return slide, idx - self.offsets[slide]
+
+    def _bundle(self, slide):
+        # file handles don't survive a fork, so every worker starts its own cache
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._open = OrderedDict()
+
+        if slide in self._open:
+            self._open.move_to_end(slide)
+        else:
+            self._open[slide] = load_bundle(self.bundle_paths[slide], mmap=True)
+            if len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        return self._open[slide]
+
+    def _item(self, slide, row, image, expr):
+        image = torch.from_numpy(image).permute(2, 0, 1)
+        if self.transform is not None:
+            image = self.transform(image)
+        item = {'image': image, 'slide': int(slide), 'index': int(self.offsets[slide] + row)}
+        if self.return_expr:
+            item['expr'] = torch.from_numpy(expr)
+        return item
+
+    def __getitem__(self, idx):
+        slide, row = self.locate(idx)
+        bundle = self._bundle(int(slide))
+        # copying out of the memmap is what actually reads the patch from disk
+        return self._item(slide, row, np.array(bundle.images[row]), np.array(bundle.expr[row]))
+
+    # batched fetch used by DataLoader, one sorted gather per slide instead of one read per patch
+    def __getitems__(self, indices):
+        slides, rows = self.locate(indices)
+        items = [None] * len(indices)
+        for slide in np.unique(slides):
+            pos = np.flatnonzero(slides == slide)
+            pos = pos[np.argsort(rows[pos])]
+            bundle = self._bundle(int(slide))
+            images = bundle.images[rows[pos]]
+            expr = bundle.expr[rows[pos]]
+            for j, p in enumerate(pos.tolist()):
+                items[p] = self._item(slide, rows[p], images[j], expr[j])
+        return items
+
+def make_loader(dataset, batch_size=256, num_workers=8, shuffle=False, **kwargs):
+    """
+    DataLoader tuned for feeding a GPU from disk: pinned memory, persistent
+    workers and a few batches prefetched per worker.
+    """
+    if num_workers > 0:
+        kwargs.setdefault('persistent_workers', True)
+        kwargs.setdefault('prefetch_factor', 4)
+    kwargs.setdefault('pin_memory', torch.cuda.is_available())
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=shuffle, **kwargs)
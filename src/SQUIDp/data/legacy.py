@@ -0,0 +1,95 @@
+# Cell-centered patch dataset from the first iteration of the project, kept for reference.
+# Superseded by SQUIDp.process and SQUIDp.data.PatchBundleDataset.
+import numpy as np
+import torch
+from PIL import Image
+from skimage.measure import regionprops
+from torch.utils.data import Dataset
+
+class PatchCells(Dataset):
+    """
+    This class takes in an histology image,
+    list of cell ids that is supposedly in that image
+    a dictionary that maps cell ids to their centroid coordinates,
+    and a patch size.
+    """
+    def __init__(self, image, cell_ids, cell_coords, patch_size=32, transform=None):
+        self.image = image
+        self.cell_ids = cell_ids
+        self.cell_coords = cell_coords
+        self.patch_size = patch_size
+        self.transform = transform
+
+    # do a filtering of the cell ids
+        self.valid_cell_ids = [id for id in cell_ids if id in cell_coords]
+
+    def __len__(self):
+        return len(self.valid_cell_ids)
+
+    # takes in a cell id, returns a {key: cell id, value: patch in tensor format}
+    def __getitem__(self, idx):
+        cell_id = self.valid_cell_ids[idx]
+        x, y = self.cell_coords[cell_id]
+
+        half_patch = self.patch_size // 2
+
+        # taking care of edge cases as well
+        x_start = max(0, x - half_patch)
+        x_end = min(self.image.shape[0], x + half_patch)
+        y_start = max(0, y - half_patch)
+        y_end = min(self.image.shape[1], y + half_patch)
+
+        # create a 0 patch first
+        patch = np.zeros((self.patch_size, self.patch_size, 3), dtype=np.float32)
+
+        # populate with actual data, note the case where cell is at edge of image
+        patch_from_in = self.image[y_start:y_end, x_start:x_end]
+        patch[:patch_from_in.shape[0], :patch_from_in.shape[1], :] = patch_from_in
+
+        patch = (patch * 255).astype(np.uint8)  
+        patch = Image.fromarray(patch)   
+
+
+        if self.transform:
+            patch = self.transform(patch)
+
+        return {
+            'cell_id': torch.tensor(cell_id, dtype=torch.int64),
+            'patch': patch.float()
+        }
+
+def get_patches(sdata, random_seed=209, transform=None, patch_size=32):
+    # pull training cells ids into a list
+    split_cell_id = sdata["cell_id-group"].obs.query("group == 'train'")["cell_id"].values
+
+    # get mask, pull regions
+    he_nuc_mask = sdata['HE_nuc_original'][0, :, :].to_numpy()
+    regions = regionprops(he_nuc_mask)
+
+    # pull centroid coordinate of each cell's regions
+    # dict has key=cell id and value=centroid coordinate
+    cell_coords = {}
+    for props in regions:
+        cid = props.label
+        if cid in split_cell_id:
+            y_center, x_center = int(props.centroid[0]), int(props.centroid[1])
+            cell_coords[cid] = (x_center, y_center)
+
+    # assemble the patch dataset
+    he_image = np.transpose(sdata['HE_original'].to_numpy(), (1, 2, 0))
+
+    np.random.seed(random_seed)
+    shuffled = np.random.permutation(split_cell_id)
+    total_len = len(split_cell_id)
+    train_len = int(0.7 * total_len)
+    val_len = int(0.2 * total_len)
+    train_ids = shuffled[:train_len]
+    val_ids = shuffled[train_len:train_len + val_len]
+    test_ids = shuffled[train_len + val_len:]
+
+    # create dataset objects
+    dataset_patch_train = PatchCells(he_image, train_ids, cell_coords, patch_size=patch_size, transform=transform)
+    dataset_patch_val = PatchCells(he_image, val_ids, cell_coords, patch_size=patch_size, transform=transform)
+    dataset_patch_test = PatchCells(he_image, test_ids, cell_coords, patch_size=patch_size, transform=transform)
+
+    return dataset_patch_train, dataset_patch_val, dataset_patch_test
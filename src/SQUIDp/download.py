@@ -0,0 +1,293 @@
+import os
+import os.path as osp
+import re
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple, Optional
+from SQUIDp.util import auto_expand, get_ids
+from SQUIDp.meta import load_meta, TISSUES
+
+HEST_REPO_ID = "MahmoodLab/hest"
+
+# folders of the HEST repo that hold each kind of per-sample artifact
+ARTIFACT_DIRS = {
+    'wsi': ['wsis'],
+    'st': ['st'],
+    'metadata': ['metadata'],
+    'cell_seg': ['xenium_seg', 'cellvit_seg'],
+    'tissue_seg': ['tissue_seg'],
+    'transcripts': ['transcripts'],
+    'thumbnail': ['thumbnails'],
+    'patches': ['patches', 'patches_vis'],
+    'spatial_plots': ['spatial_plots'],
+}
+# what processing needs: the slide, its expression and cell tables and metadata
+DEFAULT_KINDS = ['wsi', 'st', 'metadata', 'cell_seg', 'tissue_seg']
+
+CHUNK_SIZE = 8 << 20
+
+class RemoteFile(NamedTuple):
+    path: str  # relative to the repo root, also where it lands under the download directory
+    size: int
+    sha256: Optional[str]  # None where the source has no checksum, then only the size is verified
+
+class HubSource:
+    """
+    Files of a Hugging Face dataset repo, read over HTTP with range requests.
+    Only LFS files (the slides and tables) come with a sha256.
+    """
+    def __init__(self, repo_id=HEST_REPO_ID, token=None, revision=None):
+        self.repo_id = repo_id
+        self.token = token
+        self.revision = revision
+
+    def list_files(self, folder):
+        from huggingface_hub import HfApi
+        from huggingface_hub.hf_api import RepoFile
+        entries = HfApi(token=self.token).list_repo_tree(self.repo_id, path_in_repo=folder, repo_type='dataset',
+                                                          revision=self.revision, recursive=True)
+        return [RemoteFile(entry.path, entry.size, entry.lfs.sha256 if entry.lfs else None)
+                for entry in entries if isinstance(entry, RepoFile)]
+
+    def iter_chunks(self, path, offset=0, chunk_size=CHUNK_SIZE):
+        """
+        Yields (offset, chunk) from offset on. The first offset is 0 when the
+        server ignores the range, then the caller restarts the file.
+        """
+        import requests
+        from huggingface_hub import hf_hub_url
+        from huggingface_hub.utils import build_hf_headers
+        headers = build_hf_headers(token=self.token)
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+        url = hf_hub_url(self.repo_id, path, repo_type='dataset', revision=self.revision)
+        with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            position = offset if response.status_code == 206 else 0
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                yield position, chunk
+                position += len(chunk)
+
+class MirrorSource:
+    """
+    A local directory laid out like the HEST repo, e.g. a copy on a shared
+    filesystem. Works offline; files are verified by size only.
+    """
+    def __init__(self, root):
+        self.root = auto_expand(root)
+
+    def list_files(self, folder):
+        files = []
+        for dirpath, _, names in os.walk(osp.join(self.root, folder)):
+            for name in names:
+                full_path = osp.join(dirpath, name)
+                files.append(RemoteFile(osp.relpath(full_path, self.root).replace(os.sep, '/'),
+                                        osp.getsize(full_path), None))
+        return sorted(files)
+
+    def iter_chunks(self, path, offset=0, chunk_size=CHUNK_SIZE):
+        with open(osp.join(self.root, path), 'rb') as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield offset, chunk
+                offset += len(chunk)
+
+def plan_downloads(source, ids, kinds=DEFAULT_KINDS):
+    '''
+    Input:
+    source: HubSource or MirrorSource
+    ids: sample ids to fetch
+    kinds: artifact kinds (keys of ARTIFACT_DIRS) for every sample, or a dict
+    that maps each sample id to its own list of kinds
+
+    Output:
+    files: list of RemoteFile, each artifact of a requested kind whose name is
+    the sample id followed by '_' or '.', as in the HEST download patterns
+    '''
+    ids = list(ids)
+    kinds_of = kinds if isinstance(kinds, dict) else {id: kinds for id in ids}
+    unknown = {kind for id in ids for kind in kinds_of.get(id, [])} - set(ARTIFACT_DIRS)
+    if unknown:
+        raise ValueError(f"Unknown artifact kinds {sorted(unknown)}, expected some of {list(ARTIFACT_DIRS)}")
+
+    # one listing per folder, shared by all samples
+    folder_ids = dict()
+    for id in ids:
+        for kind in kinds_of.get(id, []):
+            for folder in ARTIFACT_DIRS[kind]:
+                folder_ids.setdefault(folder, set()).add(id)
+
+    files = []
+    for folder, folder_id_set in sorted(folder_ids.items()):
+        pattern = re.compile("^(" + "|".join(re.escape(id) for id in sorted(folder_id_set)) + ")[_.]")
+        files += [file for file in source.list_files(folder) if pattern.match(osp.basename(file.path))]
+    return files
+
+def _sha256_of(path, chunk_size=CHUNK_SIZE):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h
+
+def is_downloaded(file, local_dir, verify=False):
+    path = osp.join(local_dir, file.path)
+    if not osp.exists(path) or osp.getsize(path) != file.size:
+        return False
+    return not verify or file.sha256 is None or _sha256_of(path).hexdigest() == file.sha256
+
+def download_file(source, file, local_dir, retries=3, backoff=2.0):
+    '''
+    Input:
+    source: HubSource or MirrorSource
+    file: RemoteFile to fetch
+    local_dir: download directory, the file is saved under its repo path
+    retries: attempts after the first one fails, each resuming where the last stopped
+    backoff: seconds before the first retry, doubled on every further one
+
+    Output:
+    n_bytes: bytes transferred
+
+    Writes to PATH.part and appends to it on every attempt (and on the next run
+    after an interruption). The file is moved into place once its size and
+    sha256 match, a part that fails the check is discarded.
+    '''
+    path = osp.join(local_dir, file.path)
+    part_path = path + ".part"
+    os.makedirs(osp.dirname(path), exist_ok=True)
+
+    n_bytes = 0
+    for attempt in range(retries + 1):
+        try:
+            offset = osp.getsize(part_path) if osp.exists(part_path) else 0
+            if offset > file.size:
+                offset = 0
+            h = _sha256_of(part_path) if offset else hashlib.sha256()
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                f.truncate(offset)
+                f.seek(offset)
+                # a part that is already whole only needs the checks below
+                chunks = source.iter_chunks(file.path, offset) if offset < file.size else []
+                for position, chunk in chunks:
+                    if position != f.tell():
+                        # the source ignored the range, start over
+                        f.seek(position)
+                        f.truncate(position)
+                        h = hashlib.sha256()
+                    f.write(chunk)
+                    h.update(chunk)
+                    n_bytes += len(chunk)
+                written = f.tell()
+
+            if written != file.size:
+                raise IOError(f"{file.path}: got {written} bytes, expected {file.size}")
+            if file.sha256 is not None and h.hexdigest() != file.sha256:
+                os.remove(part_path)
+                raise IOError(f"{file.path}: sha256 mismatch")
+            os.replace(part_path, path)
+            return n_bytes
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def download_files(source, files, local_dir, workers=8, retries=3, verify_existing=False, log=print):
+    '''
+    Input:
+    source: HubSource or MirrorSource
+    files: list of RemoteFile, see plan_downloads
+    local_dir: download directory
+    workers: number of files fetched at once
+    retries: see download_file
+    verify_existing: also check the sha256 of files already on disk, not only their size
+
+    Output:
+    failed: a dict that maps each file path that could not be fetched to its error
+    '''
+    todo = [file for file in files if not is_downloaded(file, local_dir, verify=verify_existing)]
+    total_bytes = sum(file.size for file in todo)
+    log(f"{len(files) - len(todo)} of {len(files)} files already downloaded, "
+        f"fetching {len(todo)} ({total_bytes / 1e9:.2f} GB) with {workers} workers")
+
+    failed = dict()
+    start = time.perf_counter()
+    done_bytes = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(download_file, source, file, local_dir, retries=retries): file for file in todo}
+        for i, future in enumerate(as_completed(futures)):
+            file = futures[future]
+            try:
+                future.result()
+                done_bytes += file.size
+            except Exception as e:
+                failed[file.path] = repr(e)
+                log(f"Failed {file.path}: {e!r}")
+                continue
+            elapsed = time.perf_counter() - start
+            log(f"[{i + 1}/{len(todo)}] {file.path} ({file.size / 1e6:.1f} MB), "
+                f"{done_bytes / 1e9:.2f} of {total_bytes / 1e9:.2f} GB at {done_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s")
+    log(f"Downloaded {len(todo) - len(failed)} of {len(todo)} files in {time.perf_counter() - start:.1f}s")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Download subset of HEST 1k")
+    parser.add_argument('--hgf_token_path', type=str, default=None,
+                        help="Path to your huggingface token file, not needed with --mirror_dir")
+    parser.add_argument('--hest_data_dir', type=str, default='~/hest_data', help="Directory to save the downloaded dataset")
+    parser.add_argument('--meta_path', type=str, default=None,
+                        help="Local HEST metadata cache, defaults to $SQUIDP_META_PATH or ~/.cache/SQUIDp")
+    parser.add_argument('--ids', type=str, nargs='+', default=None,
+                        help="Sample ids to fetch, defaults to the Xenium samples of the project's tissues")
+    parser.add_argument('--kinds', type=str, nargs='+', default=DEFAULT_KINDS, choices=list(ARTIFACT_DIRS),
+                        help="Artifact kinds to fetch for each sample")
+    parser.add_argument('--workers', type=int, default=8, help="Number of files fetched at once")
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--verify_existing', action='store_true',
+                        help="Check the sha256 of files already downloaded, not only their size")
+    parser.add_argument('--mirror_dir', type=str, default=None,
+                        help="Copy from a local directory laid out like the HEST repo instead of the hub")
+    parser.add_argument('--backend', type=str, default='files', choices=['files', 'datasets'],
+                        help="'datasets' fetches every artifact through datasets.load_dataset, as before")
+    args = parser.parse_args()
+
+    api_token = None
+    if args.hgf_token_path is not None:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=auto_expand(args.hgf_token_path))
+        api_token = os.getenv("API_TOKEN")
+
+    local_dir=auto_expand(args.hest_data_dir)
+    if not osp.exists(local_dir):
+        os.makedirs(local_dir)
+    if args.ids is not None:
+        ids_to_query = args.ids
+    else:
+        meta_df = load_meta(args.meta_path and auto_expand(args.meta_path))
+        ids_to_query = get_ids(meta_df, TISSUES)
+
+    if args.backend == 'datasets':
+        import datasets
+        from huggingface_hub import login
+        login(token=api_token)
+        list_patterns = [f"*{id}[_.]**" for id in ids_to_query]
+        dataset = datasets.load_dataset(
+            'MahmoodLab/hest',
+            cache_dir=local_dir,
+            patterns=list_patterns
+        )
+        return
+
+    source = MirrorSource(args.mirror_dir) if args.mirror_dir else HubSource(token=api_token)
+    files = plan_downloads(source, ids_to_query, args.kinds)
+    failed = download_files(source, files, local_dir, workers=args.workers, retries=args.retries,
+                            verify_existing=args.verify_existing)
+    if failed:
+        raise SystemExit(f"{len(failed)} files failed, rerun to resume them")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import os
+import os.path as osp
+import re
+import json
+import hashlib
+import argparse
+import importlib
+import datetime
+import numpy as np
+from SQUIDp.util import auto_expand, atomic_open, fingerprint
+from SQUIDp.data import find_processed_bundles, read_meta
+
+# torch and timm are imported by the functions that use them, so --help starts instantly
+
+def _resolve(value):
+    """
+    Turns 'module:attr' strings into the object they name, so layer classes
+    can be passed to timm.create_model from the command line.
+    """
+    if isinstance(value, str) and re.fullmatch(r"[\w.]+:[\w.]+", value):
+        module, attr = value.split(':')
+        obj = importlib.import_module(module)
+        for part in attr.split('.'):
+            obj = getattr(obj, part)
+        return obj
+    return value
+
+def load_encoder(model_name, checkpoint=None, model_kwargs=None):
+    """
+    Creates a timm image encoder without its classification head. With a
+    checkpoint the weights come from that state dict instead of the hub; it must
+    cover every weight of the encoder, only classifier weights may be left over.
+    """
+    import timm
+    import torch
+    model_kwargs = {k: _resolve(v) for k, v in (model_kwargs or {}).items()}
+    model = timm.create_model(model_name, pretrained=checkpoint is None, num_classes=0, **model_kwargs)
+    if checkpoint is not None:
+        state_dict = torch.load(checkpoint, map_location='cpu')
+        result = model.load_state_dict(state_dict.get('state_dict', state_dict), strict=False)
+        # the head was dropped with num_classes=0, its weights in the checkpoint are expected
+        classifier = getattr(model, 'pretrained_cfg', {}).get('classifier') or 'head'
+        unexpected = [key for key in result.unexpected_keys if not key.startswith(classifier + ".")]
+        if result.missing_keys or unexpected:
+            raise ValueError(f"{checkpoint} does not match {model_name}: missing keys {result.missing_keys}, "
+                             f"unexpected keys {unexpected}")
+    return model.eval()
+
+def weights_hash(model) -> str:
+    """
+    Hash of the name, dtype, shape and bytes of every parameter and buffer, so
+    the cache tells two checkpoints of the same architecture apart. 0-d buffers
+    (e.g. BatchNorm's num_batches_tracked) are hashed as 1-element tensors.
+    """
+    import torch
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu()
+        h.update(f"{name}\t{tensor.dtype}\t{tuple(tensor.shape)}".encode())
+        h.update(tensor.reshape(-1).contiguous().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+def input_config(model):
+    """
+    Input size and normalization the encoder was trained with.
+    """
+    from timm.data import resolve_data_config
+    config = resolve_data_config({}, model=model)
+    return config['input_size'][-1], config['mean'], config['std']
+
+def prepare_batch(images, input_size, mean, std, device, dtype=None):
+    """
+    (B, 3, H, W) uint8 -> normalized float batch on device; resizing and
+    normalization run on the device so workers only ship raw bytes.
+    """
+    import torch
+    import torch.nn.functional as F
+    dtype = dtype or torch.float32
+    images = images.to(device, non_blocking=True).to(dtype).div_(255)
+    if images.shape[-1] != input_size or images.shape[-2] != input_size:
+        images = F.interpolate(images, size=(input_size, input_size), mode='bilinear', antialias=True,
+                               align_corners=False)
+    mean = torch.tensor(mean, device=device, dtype=dtype).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=device, dtype=dtype).view(1, -1, 1, 1)
+    return (images - mean) / std
+
+def pool_tokens(features, pool='cls'):
+    """
+    Reduces (B, T, D) token outputs to one vector per patch; 'cls_mean'
+    concatenates the class token with the mean patch token (Virchow style).
+    """
+    import torch
+    if features.ndim == 2:
+        return features
+    if pool == 'cls':
+        return features[:, 0]
+    if pool == 'mean':
+        return features[:, 1:].mean(dim=1)
+    if pool == 'cls_mean':
+        return torch.cat([features[:, 0], features[:, 1:].mean(dim=1)], dim=-1)
+    raise ValueError(f"Unknown pool: {pool}")
+
+def cache_paths(cache_dir, model_name, weights_digest, patch_size, bundle_path):
+    """
+    Embedding cache layout, keyed by model name and weights hash, patch size
+    and slide: <cache_dir>/<model>_<hash>/p<patch_size>/<slide>_{embeddings,metadata}.npy
+    """
+    model_tag = re.sub(r"[^\w.-]+", "_", model_name) + "_" + weights_digest[:12]
+    base = osp.join(cache_dir, model_tag, f"p{patch_size}", osp.basename(osp.normpath(bundle_path)))
+    return {
+        'embeddings': base + "_embeddings.npy",
+        'metadata': base + "_metadata.npy",
+        'cache': base + "_cache.json",
+    }
+
+def bundle_fingerprint(bundle_path):
+    return fingerprint([osp.join(bundle_path, name) for name in os.listdir(bundle_path)], root=bundle_path)
+
+def is_cached(paths, key):
+    if not all(osp.exists(path) for path in paths.values()):
+        return False
+    with open(paths['cache'], 'r') as f:
+        return json.load(f).get('key') == key
+
+def _write_slide(paths, key, bundle_path, embeddings):
+    """
+    Saves one slide's embeddings and the metadata rows the eval notebooks
+    read: (bundle name, row, patch id, expression vector).
+    """
+    from SQUIDp.data import load_bundle
+    bundle = load_bundle(bundle_path)
+    name = osp.basename(osp.normpath(bundle_path))
+    metadata = np.empty((len(bundle), 4), dtype=object)
+    for row in range(len(bundle)):
+        metadata[row] = (name, row, tuple(bundle.coords[row].tolist()), np.asarray(bundle.expr[row]))
+
+    os.makedirs(osp.dirname(paths['embeddings']), exist_ok=True)
+    with atomic_open(paths['embeddings'], 'wb') as f:
+        np.save(f, embeddings)
+    with atomic_open(paths['metadata'], 'wb') as f:
+        np.save(f, metadata, allow_pickle=True)
+    # written last, its presence marks the slide as cached
+    with atomic_open(paths['cache'], 'w') as f:
+        json.dump({'key': key, 'n_patches': len(embeddings),
+                   'finished': datetime.datetime.now().isoformat(timespec='seconds')}, f, indent=1)
+
+def embed_bundles(bundle_paths, model, model_name, cache_dir, batch_size=256, num_workers=8, device=None,
+                  precision=None, pool='cls', log=print):
+    """
+    Embeds every patch of the given bundles, skipping slides whose cache entry
+    matches the current bundle contents, model name and weights.
+
+    Data loading overlaps with inference through a multi-worker DataLoader;
+    on CPU the model runs under torch.inference_mode, optionally in bfloat16.
+
+    Returns a dict mapping each bundle path to its embeddings file.
+    """
+    import torch
+    from SQUIDp.data import PatchBundleDataset, make_loader
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    if precision is None:
+        precision = 'fp16' if device.type == 'cuda' else 'fp32'
+    autocast_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+
+    digest = weights_hash(model)
+    input_size, mean, std = input_config(model)
+
+    # figure out which slides still need work
+    outputs, todo = dict(), []
+    for bundle_path in bundle_paths:
+        meta = read_meta(bundle_path)
+        paths = cache_paths(cache_dir, model_name, digest, meta['patch_size'], bundle_path)
+        key = {'slide': meta.get('id', osp.basename(bundle_path)), 'patch_size': meta['patch_size'],
+               'model': model_name, 'weights': digest, 'pool': pool, 'bundle': bundle_fingerprint(bundle_path)}
+        outputs[bundle_path] = paths['embeddings']
+        if is_cached(paths, key):
+            continue
+        todo.append((bundle_path, paths, key))
+    log(f"Embedding {len(todo)} of {len(bundle_paths)} slides with {model_name} ({digest[:12]}), "
+        f"{len(bundle_paths) - len(todo)} cached")
+    if not todo:
+        return outputs
+
+    model = model.to(device)
+    if device.type == 'cpu':
+        model = model.to(memory_format=torch.channels_last)
+    dataset = PatchBundleDataset([bundle_path for bundle_path, _, _ in todo], return_expr=False)
+    loader = make_loader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+
+    # batches arrive in slide order, each slide is flushed as soon as its last patch is embedded
+    current, embeddings, filled = None, None, 0
+    with torch.inference_mode():
+        for batch in loader:
+            images = prepare_batch(batch['image'], input_size, mean, std, device)
+            if device.type == 'cpu':
+                images = images.contiguous(memory_format=torch.channels_last)
+            if autocast_dtype is not None:
+                with torch.autocast(device_type=device.type, dtype=autocast_dtype):
+                    features = model(images)
+            else:
+                features = model(images)
+            features = pool_tokens(features, pool).float().cpu().numpy()
+
+            slides = batch['slide'].numpy()
+            for slide in np.unique(slides):
+                rows = features[slides == slide]
+                if slide != current:
+                    current, filled = slide, 0
+                    embeddings = np.empty((dataset.metas[slide]['n_patches'], rows.shape[1]), dtype=np.float32)
+                embeddings[filled:filled + len(rows)] = rows
+                filled += len(rows)
+                if filled == len(embeddings):
+                    bundle_path, paths, key = todo[slide]
+                    _write_slide(paths, key, bundle_path, embeddings)
+                    log(f"Embedded {bundle_path}: {embeddings.shape}")
+
+    # slides without any patch never show up in a batch
+    for slide, (bundle_path, paths, key) in enumerate(todo):
+        if dataset.metas[slide]['n_patches'] == 0:
+            _write_slide(paths, key, bundle_path, np.empty((0, 0), dtype=np.float32))
+
+    return outputs
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed processed patches with a foundation model")
+    parser.add_argument('--processed_dir', type=str, required=True, help="Output directory of squidp-process")
+    parser.add_argument('--cache_dir', type=str, required=True, help="Directory for the embedding cache")
+    parser.add_argument('--model', type=str, required=True, help="timm model name, e.g. hf-hub:paige-ai/Virchow2")
+    parser.add_argument('--checkpoint', type=str, default=None, help="Optional state dict to load instead of hub weights")
+    parser.add_argument('--model_kwargs', type=str, default=None,
+                        help="JSON kwargs for timm.create_model, 'module:attr' strings are imported")
+    parser.add_argument('--pool', type=str, default='cls', choices=['cls', 'mean', 'cls_mean'],
+                        help="How to reduce token outputs to one embedding per patch")
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                        help="Autocast dtype, defaults to fp16 on cuda and fp32 on cpu")
+    args = parser.parse_args()
+
+    processed_dir = auto_expand(args.processed_dir)
+    bundle_paths = find_processed_bundles(processed_dir)
+    if not bundle_paths:
+        parser.error(f"no processed bundles in {processed_dir} or its patch_<size> folders")
+    model_kwargs = json.loads(args.model_kwargs) if args.model_kwargs else None
+    model = load_encoder(args.model, checkpoint=args.checkpoint, model_kwargs=model_kwargs)
+    embed_bundles(bundle_paths, model, args.model, auto_expand(args.cache_dir),
+                  batch_size=args.batch_size, num_workers=args.num_workers, device=args.device,
+                  precision=args.precision, pool=args.pool)
+
+if __name__ == "__main__":
+    main()
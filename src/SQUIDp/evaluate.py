@@ -0,0 +1,339 @@
+import os
+import os.path as osp
+import csv
+import time
+import argparse
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from SQUIDp.util import auto_expand
+from SQUIDp.data.bundle import load_bundle
+
+MODELS = ['ridge', 'mlp']
+MODES = ['within', 'cross']
+EMBEDDINGS_SUFFIX = "_embeddings.npy"
+
+def score_predictions(y_true, y_pred, gene_names=None, spearman=True):
+    """
+    Per-gene metrics of (n_patches, n_genes) predictions as rows of
+    {'gene', 'pearson', 'spearman', 'mse', 'mae'}, all NaN without any patch.
+    """
+    from SQUIDp.metrics import gene_metrics
+    if len(y_true) == 0:
+        n_genes = np.shape(y_true)[1] if np.ndim(y_true) == 2 else 0
+        names = ['pearson', 'mse', 'mae'] + (['spearman'] if spearman else [])
+        metrics = {name: np.full(n_genes, np.nan) for name in names}
+    else:
+        metrics = gene_metrics(y_true, y_pred, spearman=spearman)
+    n_genes = len(metrics['pearson'])
+    if gene_names is None:
+        gene_names = [f"gene_{i}" for i in range(n_genes)]
+    return [{'gene': gene, **{name: float(values[i]) for name, values in metrics.items()}}
+            for i, gene in enumerate(gene_names)]
+
+def write_rows(path, rows):
+    os.makedirs(osp.dirname(osp.abspath(path)), exist_ok=True)
+    columns = list(rows[0]) if rows else ['gene']
+    # quoted where needed, slide ids and gene names may hold commas
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def find_slides(embeddings_dir, processed_dir):
+    """
+    Pairs every <slide>_embeddings.npy of an embedding cache folder (see
+    SQUIDp.embed.cache_paths) with the bundle of the same name, as a sorted
+    list of (slide, embeddings path, bundle path).
+    """
+    slides = []
+    for name in sorted(os.listdir(embeddings_dir)):
+        if not name.endswith(EMBEDDINGS_SUFFIX):
+            continue
+        slide = name[:-len(EMBEDDINGS_SUFFIX)]
+        bundle_path = osp.join(processed_dir, slide)
+        if osp.isdir(bundle_path):
+            slides.append((slide, osp.join(embeddings_dir, name), bundle_path))
+    return slides
+
+def load_xy(embeddings_path, bundle_path, genes=None, log1p=False):
+    '''
+    Input:
+    embeddings_path: (n_patches, d) embeddings of a slide
+    bundle_path: the processed slide the embeddings were computed from
+    genes: optional gene names to keep, in this order
+    log1p: regress log1p of the expression
+
+    Output:
+    (X, Y, genes) float32 arrays and the gene names of the columns of Y,
+    the expression read straight from the bundle (no pickled metadata)
+    '''
+    X = np.load(embeddings_path)
+    bundle = load_bundle(bundle_path)
+    if len(X) != len(bundle):
+        raise ValueError(f"{embeddings_path} has {len(X)} rows, {bundle_path} has {len(bundle)} patches")
+    if genes is None:
+        genes, Y = bundle.genes, bundle.expr
+    else:
+        Y = bundle.expr[:, _gene_columns(bundle.genes, genes)]
+    Y = np.asarray(Y, dtype=np.float32)
+    if log1p:
+        Y = np.log1p(Y)
+    return np.asarray(X, dtype=np.float32), Y, np.asarray(genes)
+
+def _gene_columns(bundle_genes, genes):
+    position = {gene: i for i, gene in enumerate(bundle_genes.tolist())}
+    return np.array([position[gene] for gene in genes], dtype=np.int64)
+
+def shared_genes(bundle_paths):
+    """
+    Genes measured in every bundle, in the order of the first one.
+    """
+    genes = None
+    for bundle_path in bundle_paths:
+        bundle_genes = load_bundle(bundle_path).genes.tolist()
+        if genes is None:
+            genes = bundle_genes
+        else:
+            measured = set(bundle_genes)
+            genes = [gene for gene in genes if gene in measured]
+    return genes or []
+
+def split_rows(n, test_frac=0.2, val_frac=0.1, seed=0):
+    """
+    Random (train, val, test) row indices of one slide, val is a fraction of what is left after test.
+    """
+    order = np.random.default_rng(seed).permutation(n)
+    n_test = int(round(n * test_frac))
+    n_val = int(round((n - n_test) * val_frac))
+    return np.sort(order[n_test + n_val:]), np.sort(order[n_test:n_test + n_val]), np.sort(order[:n_test])
+
+def _fit(model, X_train, Y_train, X_val, Y_val, model_kwargs):
+    from SQUIDp.regressors import ridge_stats, select_ridge, fit_mlp
+    if model == 'ridge':
+        return select_ridge(ridge_stats(X_train, Y_train), ridge_stats(X_val, Y_val), **model_kwargs)
+    return fit_mlp(X_train, Y_train, X_val, Y_val, **model_kwargs)
+
+def _result_rows(model, fitted, mode, fold, slide, y_true, y_pred, genes, n_train, spearman):
+    rows = []
+    for i, row in enumerate(score_predictions(y_true, y_pred, gene_names=genes.tolist(), spearman=spearman)):
+        row = {'model': model, 'mode': mode, 'fold': fold, 'slide': slide, **row, 'n_train': n_train, 'n_test': len(y_true)}
+        if model == 'ridge':
+            row['alpha'] = float(fitted.alpha[i])
+        else:
+            row['epochs'] = fitted.epochs
+        rows.append(row)
+    return rows
+
+def evaluate_within(model, slide, embeddings_path, bundle_path, test_frac=0.2, val_frac=0.1, log1p=False, seed=0,
+                    spearman=True, model_kwargs=None):
+    '''
+    Input:
+    model: 'ridge' or 'mlp'
+    slide, embeddings_path, bundle_path: see find_slides
+    test_frac: fraction of the patches held out for scoring
+    val_frac: fraction of the rest held out to pick the ridge penalties or stop the MLP early
+    log1p, seed, spearman: see load_xy, split_rows and score_predictions
+    model_kwargs: forwarded to select_ridge or fit_mlp
+
+    Output:
+    rows: one row of metrics per gene of the slide
+    '''
+    X, Y, genes = load_xy(embeddings_path, bundle_path, log1p=log1p)
+    train, val, test = split_rows(len(X), test_frac=test_frac, val_frac=val_frac, seed=seed)
+    fitted = _fit(model, X[train], Y[train], X[val], Y[val], model_kwargs or dict())
+    return _result_rows(model, fitted, 'within', 0, slide, Y[test], fitted.predict(X[test]), genes, len(train), spearman)
+
+def _fold_stats(slides, genes, log1p):
+    from SQUIDp.regressors import ridge_stats
+    stats = None
+    for _, embeddings_path, bundle_path in slides:
+        X, Y, _ = load_xy(embeddings_path, bundle_path, genes=genes, log1p=log1p)
+        slide_stats = ridge_stats(X, Y)
+        stats = slide_stats if stats is None else stats + slide_stats
+    return stats
+
+def _fit_fold_mlp(train_slides, val_slides, genes, log1p, model_kwargs):
+    from SQUIDp.regressors import fit_mlp
+    def _stack(slides):
+        data = [load_xy(embeddings_path, bundle_path, genes=genes, log1p=log1p)[:2]
+                for _, embeddings_path, bundle_path in slides]
+        return np.concatenate([x for x, _ in data]), np.concatenate([y for _, y in data])
+    (X_train, Y_train), (X_val, Y_val) = _stack(train_slides), _stack(val_slides)
+    return fit_mlp(X_train, Y_train, X_val, Y_val, **model_kwargs), len(X_train)
+
+def _score_slide(model, fitted, fold, slide, embeddings_path, bundle_path, genes, n_train, log1p, spearman):
+    X, Y, genes = load_xy(embeddings_path, bundle_path, genes=genes, log1p=log1p)
+    return _result_rows(model, fitted, 'cross', fold, slide, Y, fitted.predict(X), genes, n_train, spearman)
+
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+def _limit_threads(threads):
+    # pool initializer, for BLAS libraries loaded before the environment could cap them
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(threads)
+
+def _run_jobs(fn, jobs, workers):
+    # each job is an args tuple, results come back in job order
+    if workers <= 1 or len(jobs) <= 1:
+        return [fn(*job) for job in jobs]
+    workers = min(workers, len(jobs))
+    # BLAS threads of every worker, so parallel fits don't start cpus x cpus threads; spawned workers
+    # read them from the environment they inherit when numpy loads
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                 initializer=_limit_threads, initargs=(threads,)) as pool:
+            futures = [pool.submit(fn, *job) for job in jobs]
+            return [future.result() for future in futures]
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def evaluate_cross(model, slides, folds=5, log1p=False, seed=0, spearman=True, workers=1, model_kwargs=None):
+    '''
+    Input:
+    model: 'ridge' or 'mlp'
+    slides: list of (slide, embeddings path, bundle path) from find_slides
+    folds: number of groups of slides, each is scored by a model fit on the others
+    (at least 3, the fold after the held-out one picks the ridge penalties or stops the MLP early)
+    log1p, seed, spearman: see load_xy, split_rows and score_predictions
+    workers: number of processes
+    model_kwargs: forwarded to select_ridge or fit_mlp
+
+    Output:
+    rows: one row of metrics per gene of every slide, on the genes all slides share
+    '''
+    from SQUIDp.regressors import select_ridge
+    folds = min(folds, len(slides))
+    if folds < 3:
+        raise ValueError(f"Cross-slide evaluation needs at least 3 slides, got {len(slides)}")
+    model_kwargs = model_kwargs or dict()
+    genes = shared_genes([bundle_path for _, _, bundle_path in slides])
+    order = np.random.default_rng(seed).permutation(len(slides))
+    fold_slides = [[slides[i] for i in sorted(order[k::folds])] for k in range(folds)]
+
+    if model == 'ridge':
+        # statistics of every fold once, each model is fit from their sums
+        fold_stats = _run_jobs(_fold_stats, [(group, genes, log1p) for group in fold_slides], workers)
+        total = fold_stats[0]
+        for stats in fold_stats[1:]:
+            total = total + stats
+        fitted = []
+        for k in range(folds):
+            val = (k + 1) % folds
+            train_stats = total - fold_stats[k] - fold_stats[val]
+            fitted.append((select_ridge(train_stats, fold_stats[val], **model_kwargs), (total - fold_stats[k]).n))
+    else:
+        fitted = _run_jobs(_fit_fold_mlp, [(sum([fold_slides[j] for j in range(folds) if j not in (k, (k + 1) % folds)], []),
+                                            fold_slides[(k + 1) % folds], genes, log1p, model_kwargs)
+                                           for k in range(folds)], workers)
+
+    jobs = [(model, fitted[k][0], k, slide, embeddings_path, bundle_path, genes, fitted[k][1], log1p, spearman)
+            for k in range(folds) for slide, embeddings_path, bundle_path in fold_slides[k]]
+    return [row for rows in _run_jobs(_score_slide, jobs, workers) for row in rows]
+
+def run_evaluation(slides, models=MODELS, mode='within', folds=5, test_frac=0.2, val_frac=0.1, log1p=False, seed=0,
+                   spearman=True, workers=1, model_kwargs=None, log=print):
+    """
+    Evaluates every model on the slides, within each slide (random patch split,
+    slides in parallel) or across slides (grouped folds). Returns a dict that
+    maps each model to its rows of per-slide, per-gene metrics. Slides without
+    any patch (embedded as an empty array) are skipped.
+    """
+    empty = [slide for slide, embeddings_path, _ in slides if len(np.load(embeddings_path, mmap_mode='r')) == 0]
+    if empty:
+        log(f"Skipping {len(empty)} slides without patches: {', '.join(empty)}")
+        slides = [entry for entry in slides if entry[0] not in set(empty)]
+    model_kwargs = model_kwargs or dict()
+    results = dict()
+    for model in models:
+        start = time.perf_counter()
+        if mode == 'within':
+            jobs = [(model, slide, embeddings_path, bundle_path, test_frac, val_frac, log1p, seed, spearman,
+                     model_kwargs.get(model)) for slide, embeddings_path, bundle_path in slides]
+            results[model] = [row for rows in _run_jobs(evaluate_within, jobs, workers) for row in rows]
+        else:
+            results[model] = evaluate_cross(model, slides, folds=folds, log1p=log1p, seed=seed, spearman=spearman,
+                                            workers=workers, model_kwargs=model_kwargs.get(model))
+        pearson = [row['pearson'] for row in results[model]]
+        mean = np.nanmean(pearson) if np.any(~np.isnan(pearson)) else np.nan
+        log(f"{model} ({mode}): mean Pearson {mean:.4f} over {len(slides)} slides and "
+            f"{len(pearson)} slide-genes in {time.perf_counter() - start:.1f}s")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Score predicted patch expression against the truth gene by gene, "
+                                                 "or fit and score regressors on cached embeddings")
+    parser.add_argument('--y_true', type=str, default=None, help=".npy of true expression, (n_patches, n_genes)")
+    parser.add_argument('--y_pred', type=str, default=None, help=".npy of predicted expression, same shape")
+    parser.add_argument('--genes', type=str, default=None, help="Text file with one gene name per line")
+    parser.add_argument('--output', type=str, default=None, help="CSV with one row of metrics per gene")
+    parser.add_argument('--no_spearman', action='store_true', help="Skip the rank correlation")
+
+    engine = parser.add_argument_group("regressors on cached embeddings")
+    engine.add_argument('--embeddings_dir', type=str, default=None,
+                        help="Embedding cache folder of one model and patch size, <cache_dir>/<model>_<hash>/p<size>")
+    engine.add_argument('--processed_dir', type=str, default=None, help="Bundles the embeddings were computed from")
+    engine.add_argument('--output_dir', type=str, default=None, help="Where <model>_results.csv is written")
+    engine.add_argument('--models', type=str, nargs='+', default=MODELS, choices=MODELS)
+    engine.add_argument('--mode', type=str, default='within', choices=MODES,
+                        help="'within' splits the patches of each slide, 'cross' holds out whole slides")
+    engine.add_argument('--folds', type=int, default=5, help="Groups of slides in cross mode")
+    engine.add_argument('--test_frac', type=float, default=0.2, help="Held-out patches of each slide in within mode")
+    engine.add_argument('--val_frac', type=float, default=0.1, help="Patches of the rest for early stopping / penalties")
+    engine.add_argument('--log1p', action='store_true', help="Regress log1p of the expression")
+    engine.add_argument('--workers', type=int, default=os.cpu_count())
+    engine.add_argument('--seed', type=int, default=0)
+    engine.add_argument('--hidden_dim', type=int, default=512)
+    engine.add_argument('--lr', type=float, default=1e-3)
+    engine.add_argument('--batch_size', type=int, default=1024, help="MLP rows per step, 0 for full-batch steps")
+    engine.add_argument('--max_epochs', type=int, default=300)
+    engine.add_argument('--patience', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.embeddings_dir is not None:
+        if args.processed_dir is None:
+            parser.error("--embeddings_dir needs --processed_dir")
+        slides = find_slides(auto_expand(args.embeddings_dir), auto_expand(args.processed_dir))
+        print(f"Found {len(slides)} slides with embeddings and a bundle")
+        # threads of the torch ops of every worker, so parallel slides don't oversubscribe the cpus
+        threads = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+        model_kwargs = {'mlp': dict(hidden_dim=args.hidden_dim, lr=args.lr, batch_size=args.batch_size or None,
+                                    max_epochs=args.max_epochs, patience=args.patience, seed=args.seed,
+                                    threads=threads)}
+        results = run_evaluation(slides, models=args.models, mode=args.mode, folds=args.folds, test_frac=args.test_frac,
+                                 val_frac=args.val_frac, log1p=args.log1p, seed=args.seed,
+                                 spearman=not args.no_spearman, workers=args.workers, model_kwargs=model_kwargs)
+        output_dir = auto_expand(args.output_dir or args.embeddings_dir)
+        for model, rows in results.items():
+            write_rows(osp.join(output_dir, f"{model}_results.csv"), rows)
+        print(f"Results in {output_dir}")
+        return
+
+    if args.y_true is None or args.y_pred is None:
+        parser.error("pass --y_true and --y_pred, or --embeddings_dir and --processed_dir")
+    y_true = np.load(auto_expand(args.y_true))
+    y_pred = np.load(auto_expand(args.y_pred))
+    gene_names = None
+    if args.genes is not None:
+        with open(auto_expand(args.genes), 'r') as f:
+            gene_names = [line.strip() for line in f if line.strip()]
+
+    rows = score_predictions(y_true, y_pred, gene_names=gene_names, spearman=not args.no_spearman)
+    for name in [name for name in rows[0] if name != 'gene'] if rows else []:
+        print(f"{name}: {np.nanmean([row[name] for row in rows]):.4f} (mean over genes)")
+    if args.output is not None:
+        write_rows(auto_expand(args.output), rows)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import os.path as osp
+import argparse
+import datetime
+from SQUIDp.util import auto_expand, atomic_open
+
+HEST_VERSION = "v1_1_0"
+HEST_META_URL = f"hf://datasets/MahmoodLab/hest/HEST_{HEST_VERSION}.csv"
+CACHE_FORMAT_VERSION = 1
+DEFAULT_META_PATH = osp.join("~", ".cache", "SQUIDp", f"hest_meta_{HEST_VERSION}.parquet")
+
+# columns samples are selected by, stored as categoricals
+INDEX_COLUMNS = ['species', 'st_technology', 'tissue', 'organ', 'oncotree_code']
+
+# tissues this project trains on
+TISSUES = ["Pancreas", "Colon", "Liver", "Kidney", "Bowel",
+           "Heart", "Brain", "Breast", "Skin", "Bone marrow", "Tonsil",
+           "Prostate", "Lymph node", "Ovary", "Femur bone"]
+
+class MetaCacheError(RuntimeError):
+    pass
+
+def default_meta_path():
+    return auto_expand(os.environ.get("SQUIDP_META_PATH", DEFAULT_META_PATH))
+
+def _cache_tags(hest_version):
+    return {b'squidp_cache_format': str(CACHE_FORMAT_VERSION).encode(),
+            b'hest_version': hest_version.encode()}
+
+def build_meta_cache(meta_path=None, source=HEST_META_URL, hest_version=HEST_VERSION):
+    """
+    Reads the HEST metadata CSV once (from the hub or a local copy) and stores
+    it as parquet, with the selection columns as categoricals and the cache
+    format and HEST versions in the file's schema metadata.
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    meta_path = meta_path or default_meta_path()
+    meta_df = pd.read_csv(auto_expand(source))
+    for column in INDEX_COLUMNS:
+        if column in meta_df.columns:
+            meta_df[column] = meta_df[column].astype('category')
+
+    table = pa.Table.from_pandas(meta_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **_cache_tags(hest_version),
+                                           b'source': str(source).encode(),
+                                           b'created': datetime.datetime.now().isoformat(timespec='seconds').encode()})
+    os.makedirs(osp.dirname(osp.abspath(meta_path)), exist_ok=True)
+    with atomic_open(meta_path, 'wb') as f:
+        pq.write_table(table, f)
+    return meta_df
+
+def read_meta_cache(meta_path=None, hest_version=HEST_VERSION):
+    """
+    Returns the cached metadata frame, or None if the cache is missing or was
+    written by another cache format or HEST version.
+    """
+    import pyarrow.parquet as pq
+
+    meta_path = meta_path or default_meta_path()
+    if not osp.exists(meta_path):
+        return None
+    tags = pq.read_schema(meta_path).metadata or {}
+    if any(tags.get(key) != value for key, value in _cache_tags(hest_version).items()):
+        return None
+    return pq.read_table(meta_path).to_pandas()
+
+def load_meta(meta_path=None, source=HEST_META_URL, hest_version=HEST_VERSION, refresh=False):
+    """
+    Returns the HEST metadata frame from the local cache, building the cache
+    from source the first time (or when refresh is set or the versions don't
+    match). Only that first build needs network access.
+    """
+    meta_path = meta_path or default_meta_path()
+    meta_df = None if refresh else read_meta_cache(meta_path, hest_version)
+    if meta_df is not None:
+        return meta_df
+    try:
+        return build_meta_cache(meta_path, source=source, hest_version=hest_version)
+    except Exception as e:
+        raise MetaCacheError(f"No usable metadata cache at {meta_path} and reading {source} failed ({e}). "
+                             f"Build it where the hub is reachable, or from a local copy of the CSV, with "
+                             f"`python -m SQUIDp.meta --source PATH_TO_CSV --meta_path {meta_path}`") from e
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local HEST metadata cache")
+    parser.add_argument('--source', type=str, default=HEST_META_URL, help="HEST metadata CSV, hf:// URL or local path")
+    parser.add_argument('--meta_path', type=str, default=None,
+                        help=f"Where to write the cache, defaults to $SQUIDP_META_PATH or {DEFAULT_META_PATH}")
+    parser.add_argument('--hest_version', type=str, default=HEST_VERSION)
+    args = parser.parse_args()
+
+    meta_path = auto_expand(args.meta_path) if args.meta_path else default_meta_path()
+    meta_df = build_meta_cache(meta_path, source=args.source, hest_version=args.hest_version)
+    print(f"Cached {len(meta_df)} samples ({args.hest_version}) to {meta_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.stats import rankdata
+
+def _constant(y):
+    """
+    Columns with a single value, where a correlation is undefined.
+    """
+    return np.ptp(y, axis=0) == 0
+
+def _column_corr(a, b, undefined):
+    """
+    Pearson correlation of every column of a with the same column of b.
+    """
+    a = a - a.mean(axis=0)
+    b = b - b.mean(axis=0)
+    denom = np.sqrt(np.einsum('ij,ij->j', a, a) * np.einsum('ij,ij->j', b, b))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.einsum('ij,ij->j', a, b) / denom
+    corr = np.clip(corr, -1.0, 1.0)
+    corr[undefined | (denom == 0)] = np.nan
+    return corr
+
+def gene_metrics(y_true, y_pred, spearman=True):
+    """
+    Per-gene Pearson, Spearman, MSE and MAE of (n_patches, n_genes) arrays,
+    all genes at once. As before, a gene whose truth or prediction is
+    constant gets a NaN correlation.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    if y_true.shape != y_pred.shape:
+        raise ValueError(f"Shape mismatch: true {y_true.shape}, pred {y_pred.shape}")
+
+    undefined = _constant(y_true) | _constant(y_pred)
+    err = y_pred - y_true
+    metrics = {
+        'pearson': _column_corr(y_true, y_pred, undefined),
+        'mse': np.mean(np.square(err), axis=0),
+        'mae': np.mean(np.abs(err), axis=0),
+    }
+    if spearman:
+        metrics['spearman'] = _column_corr(rankdata(y_true, axis=0), rankdata(y_pred, axis=0), undefined)
+    return metrics
+
+def pearson_corr(y_true, y_pred):
+    """
+    Drop-in for the notebooks' helper: (mean over genes ignoring NaN, per-gene list).
+    """
+    corrs = gene_metrics(y_true, y_pred, spearman=False)['pearson']
+    mean = np.nanmean(corrs) if np.any(~np.isnan(corrs)) else np.nan
+    return mean, corrs.tolist()
+
+class StreamingGeneMetrics:
+    """
+    Accumulates per-gene Pearson, MSE and MAE chunk by chunk, so predictions
+    that don't fit in memory can be scored. Values are shifted by the first
+    row seen, which keeps the sums well conditioned and makes constant genes
+    exactly constant. Spearman needs global ranks and is not streamed.
+    """
+    def __init__(self):
+        self.n = 0
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        if y_true.shape != y_pred.shape:
+            raise ValueError(f"Shape mismatch: true {y_true.shape}, pred {y_pred.shape}")
+        if len(y_true) == 0:
+            return self
+
+        if self.n == 0:
+            n_genes = y_true.shape[1]
+            self.shift_true, self.shift_pred = y_true[0].copy(), y_pred[0].copy()
+            self.sum_t, self.sum_p = np.zeros(n_genes), np.zeros(n_genes)
+            self.sum_tt, self.sum_pp, self.sum_tp = np.zeros(n_genes), np.zeros(n_genes), np.zeros(n_genes)
+            self.sum_sq_err, self.sum_abs_err = np.zeros(n_genes), np.zeros(n_genes)
+            self.varies_t, self.varies_p = np.zeros(n_genes, dtype=bool), np.zeros(n_genes, dtype=bool)
+
+        err = y_pred - y_true
+        self.sum_sq_err += np.einsum('ij,ij->j', err, err)
+        self.sum_abs_err += np.abs(err).sum(axis=0)
+
+        t = y_true - self.shift_true
+        p = y_pred - self.shift_pred
+        self.varies_t |= np.any(t != 0, axis=0)
+        self.varies_p |= np.any(p != 0, axis=0)
+        self.sum_t += t.sum(axis=0)
+        self.sum_p += p.sum(axis=0)
+        self.sum_tt += np.einsum('ij,ij->j', t, t)
+        self.sum_pp += np.einsum('ij,ij->j', p, p)
+        self.sum_tp += np.einsum('ij,ij->j', t, p)
+        self.n += len(y_true)
+        return self
+
+    def compute(self):
+        if self.n == 0:
+            raise ValueError("No data was added")
+        n = self.n
+        cov = self.sum_tp - self.sum_t * self.sum_p / n
+        var_t = np.maximum(self.sum_tt - self.sum_t ** 2 / n, 0)
+        var_p = np.maximum(self.sum_pp - self.sum_p ** 2 / n, 0)
+        denom = np.sqrt(var_t * var_p)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pearson = np.clip(cov / denom, -1.0, 1.0)
+        pearson[~self.varies_t | ~self.varies_p | (denom == 0)] = np.nan
+        return {
+            'pearson': pearson,
+            'mse': self.sum_sq_err / n,
+            'mae': self.sum_abs_err / n,
+        }
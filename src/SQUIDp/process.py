@@ -0,0 +1,1249 @@
+## goal: modify such that it patches 224x224 pixel, and obtain average expression for that patch
+# heavy dependencies (hest, matplotlib, scipy, pandas, PIL) are imported by the functions that use them,
+# so --help and runs with nothing left to do start instantly
+import SQUIDp.util as sqd
+import numpy as np
+import os
+import os.path as osp
+import datetime
+from SQUIDp.util import auto_expand, atomic_open
+from SQUIDp.data.bundle import PatchBundleWriter, is_bundle, read_meta
+from SQUIDp.profiling import StageProfiler, stage, maybe_cprofile
+from SQUIDp.meta import load_meta, TISSUES
+import pickle
+import json
+import warnings
+import argparse
+import shutil
+import traceback
+import time
+from contextlib import contextmanager, nullcontext
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import NamedTuple
+warnings.filterwarnings("ignore", category=UserWarning, module="zarr.creation")
+
+MANIFEST_NAME = "manifest.json"
+
+# log_file may be a path or an already open file, so a slide can keep a single handle open
+@contextmanager
+def _log_handle(log_file):
+    if hasattr(log_file, 'write'):
+        yield log_file
+    else:
+        with open(log_file, 'a') as f:
+            yield f
+
+# json lines with the per-stage timings live next to the text log
+def _jsonl_path(log_file):
+    return osp.splitext(log_file)[0] + '.jsonl'
+
+# edited to match hest format 6/26
+# CSR-style grouping of cells into patches, see get_cell_ids_in_patch
+class PatchBins(NamedTuple):
+    '''
+    keys: (n_patches, 2) int64 array of (y_patch_idx, x_patch_idx), sorted row-major
+    offsets: (n_patches + 1,) int64 array, the cells of patch i live in [offsets[i], offsets[i + 1])
+    cell_index: (n_cells,) int64 array of positions in sdata['locations'], grouped by patch
+    cell_ids: (n_cells,) array of cell ids aligned with cell_index
+    '''
+    keys: np.ndarray
+    offsets: np.ndarray
+    cell_index: np.ndarray
+    cell_ids: np.ndarray
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def n_patches(self):
+        return len(self.keys)
+
+# bins cell centroids into a grid of patch_size x patch_size patches
+def bin_cells(x, y, patch_size, cell_ids=None):
+    '''
+    Input:
+    x, y: arrays of cell centroid coordinates at level 0
+    patch_size: size of the patch
+    cell_ids: optional array of cell ids aligned with x and y, defaults to positions
+
+    Output:
+    PatchBins grouping of the cells by (y_patch_idx, x_patch_idx)
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if cell_ids is None:
+        cell_ids = np.arange(len(x))
+    cell_ids = np.asarray(cell_ids)
+
+    # cells without a usable centroid can't be placed in a patch
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(valid) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return PatchBins(np.empty((0, 2), dtype=np.int64), np.zeros(1, dtype=np.int64), empty, cell_ids[:0])
+
+    # find y, x index of the bucket each cell should be in
+    y_patch_idx = np.floor_divide(y[valid], patch_size).astype(np.int64)
+    x_patch_idx = np.floor_divide(x[valid], patch_size).astype(np.int64)
+
+    # flatten (y, x) into one integer so a single stable sort groups the cells row-major
+    x_min, y_min = x_patch_idx.min(), y_patch_idx.min()
+    n_cols = x_patch_idx.max() - x_min + 1
+    flat_key = (y_patch_idx - y_min) * n_cols + (x_patch_idx - x_min)
+    order = np.argsort(flat_key, kind='stable')
+    flat_key = flat_key[order]
+
+    # each run of equal keys is one patch
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(flat_key)) + 1))
+    offsets = np.append(starts, len(flat_key)).astype(np.int64)
+    keys = np.stack([y_patch_idx[order[starts]], x_patch_idx[order[starts]]], axis=1)
+    cell_index = valid[order]
+
+    return PatchBins(keys, offsets, cell_index, cell_ids[cell_index])
+
+# keeps only the patches selected by a boolean mask
+def subset_patch_bins(patch_bins, mask):
+    '''
+    Input:
+    patch_bins: PatchBins
+    mask: (n_patches,) boolean array of patches to keep
+
+    Output:
+    PatchBins with only the selected patches
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    counts = patch_bins.counts
+    cell_mask = np.repeat(mask, counts)
+    offsets = np.concatenate(([0], np.cumsum(counts[mask]))).astype(np.int64)
+    return PatchBins(patch_bins.keys[mask], offsets, patch_bins.cell_index[cell_mask], patch_bins.cell_ids[cell_mask])
+
+# keeps a contiguous range of patches [start, stop), whose cells are contiguous as well
+def slice_patch_bins(patch_bins, start, stop):
+    lo, hi = patch_bins.offsets[start], patch_bins.offsets[stop]
+    return PatchBins(patch_bins.keys[start:stop], patch_bins.offsets[start:stop + 1] - lo,
+                     patch_bins.cell_index[lo:hi], patch_bins.cell_ids[lo:hi])
+
+# pulls all cell centroids out of sdata in one call instead of walking the shapely points
+def cell_centroids(sdata):
+    '''
+    Input:
+    sdata: spatialdata object
+
+    Output:
+    (x, y, cell_ids) arrays of the cell centroids at level 0
+    '''
+    geometry = sdata['locations']['geometry']
+    return geometry.x.to_numpy(), geometry.y.to_numpy(), geometry.index.to_numpy()
+
+# given a patch size, group the cell ids by patch
+def get_cell_ids_in_patch(sdata, patch_size=224, log_file=None, centroids=None):
+    '''
+    Input:
+    sdata: spatialdata object
+    patch_size: size of the patch
+    centroids: optional (x, y, cell_ids) from cell_centroids, to reuse across patch sizes
+
+    Output:
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    '''
+    if centroids is None:
+        centroids = cell_centroids(sdata)
+    x, y, cell_ids = centroids
+    patch_bins = bin_cells(x, y, patch_size, cell_ids=cell_ids)
+    cell_counts = patch_bins.counts
+
+    # collect stats
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            f.write(f"Number of cells in this slide: {len(x)}\n")
+            f.write(f"Number of patches: {patch_bins.n_patches}\n")
+            f.write(f"Patch size: {patch_size}\n")
+            if len(cell_counts):
+                f.write(f"Minimum number of cells in a patch: {cell_counts.min()}\n")
+                f.write(f"Maximum number of cells in a patch: {cell_counts.max()}\n")
+                f.write(f"Average number of cells in a patch: {cell_counts.mean():.3f}\n")
+            else:
+                f.write("No cells found in any patches.\n")
+
+    return patch_bins
+
+# native tile size (width, height) of level 0, if the wsi backend exposes one
+def _wsi_tile_size(wsi):
+    properties = getattr(getattr(wsi, 'img', None), 'properties', None)
+    try:
+        return int(properties['openslide.level[0].tile-width']), int(properties['openslide.level[0].tile-height'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+# threshold between the two modes of a uint8 histogram, maximizing the between-class variance
+def _otsu_threshold(values):
+    hist = np.bincount(np.asarray(values, dtype=np.uint8).ravel(), minlength=256).astype(np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    cum_mean = np.cumsum(hist * np.arange(256))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_bg = cum_mean / weight_bg
+        mean_fg = (cum_mean[-1] - cum_mean) / weight_fg
+        between = weight_bg * weight_fg * np.square(mean_bg - mean_fg)
+    return int(np.nanargmax(between[:-1])) if np.any(np.isfinite(between[:-1])) else 0
+
+# settings of the thumbnail tissue mask, recorded in the manifest so changing them reprocesses the slides
+TISSUE_MASK_SETTINGS = {'thumbnail_size': 2048, 'min_saturation': 15}
+
+# low resolution tissue mask of a slide, from the saturation of its thumbnail
+def tissue_mask(wsi, thumbnail_size=TISSUE_MASK_SETTINGS['thumbnail_size'],
+                min_saturation=TISSUE_MASK_SETTINGS['min_saturation']):
+    '''
+    Input:
+    wsi: whole slide image
+    thumbnail_size: longest side of the thumbnail the mask is computed on
+    min_saturation: lower bound on the Otsu threshold, so a slide that is all tissue isn't split in two
+
+    Output:
+    mask: (h, w) boolean array, True where there is tissue
+    scale: (sx, sy) level 0 pixels per mask pixel
+    threshold: saturation threshold that was used
+    '''
+    ratio = thumbnail_size / max(wsi.width, wsi.height)
+    width, height = max(1, int(round(wsi.width * ratio))), max(1, int(round(wsi.height * ratio)))
+    thumbnail = np.asarray(wsi.get_thumbnail(width, height))[..., :3].astype(np.int16)
+
+    # glass is bright and grey, stained tissue is saturated; near-black borders and pen marks are not tissue
+    rgb_max, rgb_min = thumbnail.max(axis=-1), thumbnail.min(axis=-1)
+    saturation = np.where(rgb_max > 0, 255 * (rgb_max - rgb_min) // np.maximum(rgb_max, 1), 0).astype(np.uint8)
+    threshold = max(_otsu_threshold(saturation), min_saturation)
+    mask = (saturation > threshold) & (rgb_max > 30)
+
+    # the thumbnail may keep the aspect ratio differently than requested
+    scale = (wsi.width / mask.shape[1], wsi.height / mask.shape[0])
+    return mask, scale, threshold
+
+# fraction of every patch covered by tissue, with an integral image of the mask
+def patch_tissue_fraction(mask, scale, keys, patch_size):
+    '''
+    Input:
+    mask, scale: from tissue_mask
+    keys: (n_patches, 2) array of (y_patch_idx, x_patch_idx)
+    patch_size: size of the patch
+
+    Output:
+    (n_patches,) array of tissue fractions in [0, 1]
+    '''
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+
+    # patch bounds in mask pixels, at least one pixel wide
+    keys = np.asarray(keys, dtype=np.int64)
+    sx, sy = scale
+    x0 = np.clip(np.floor(keys[:, 1] * patch_size / sx).astype(np.int64), 0, mask.shape[1] - 1)
+    y0 = np.clip(np.floor(keys[:, 0] * patch_size / sy).astype(np.int64), 0, mask.shape[0] - 1)
+    x1 = np.clip(np.ceil((keys[:, 1] + 1) * patch_size / sx).astype(np.int64), x0 + 1, mask.shape[1])
+    y1 = np.clip(np.ceil((keys[:, 0] + 1) * patch_size / sy).astype(np.int64), y0 + 1, mask.shape[0])
+
+    tissue = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return tissue / ((y1 - y0) * (x1 - x0))
+
+# drops the patches that are mostly background before any of them is read at level 0
+def filter_tissue_patches(patch_bins, mask, scale, patch_size=224, min_tissue_frac=0.25, log_file=None):
+    '''
+    Input:
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    mask, scale: from tissue_mask
+    min_tissue_frac: patches with a smaller fraction of tissue are dropped
+
+    Output:
+    patch_bins: the PatchBins restricted to patches with enough tissue
+    keep: (n_patches,) boolean array of the kept patches of the input
+    '''
+    tissue_frac = patch_tissue_fraction(mask, scale, patch_bins.keys, patch_size)
+    keep = tissue_frac >= min_tissue_frac
+
+    # collect stats
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            f.write(f"Deleted {np.count_nonzero(~keep)} of {patch_bins.n_patches} patches with less than "
+                    f"{min_tissue_frac:.0%} tissue ({int(patch_bins.counts[~keep].sum())} cells)\n")
+    return subset_patch_bins(patch_bins, keep), keep
+
+# saves the tissue mask next to the slide's plots and logs where it went
+def save_tissue_mask(mask, threshold, id, plot_dir, log_file=None):
+    from PIL import Image
+    mask_path = osp.join(plot_dir, f"tissue_mask_{id}.png")
+    Image.fromarray(mask.astype(np.uint8) * 255).save(mask_path)
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            f.write(f"Tissue mask: {mask.shape[1]}x{mask.shape[0]}, saturation threshold {threshold}, "
+                    f"{mask.mean():.1%} tissue, saved to {mask_path}\n")
+
+# reads patches in bulk, one region per run of neighbouring patches
+def iter_patch_regions(wsi, keys, patch_size=224, max_gap=1, max_region_width=16384):
+    '''
+    Input:
+    wsi: whole slide image to read from
+    keys: (n_patches, 2) array of (y_patch_idx, x_patch_idx), all within the bounds of the wsi
+    patch_size: size of the patch
+    max_gap: number of empty patches a run may bridge before a new region is started
+    max_region_width: upper bound in pixels on the width of a single region
+
+    Output:
+    yields (i, patch_np) in row-major order, where patch_np is a (patch_size, patch_size, 3) uint8
+    view into the region it was read with and i indexes keys
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(keys) == 0:
+        return
+
+    # group patch rows into bands by the native tile row their top edge falls in, counted from the
+    # top of the slide, so the rows of a band share the tiles they start in; one patch row per band
+    # otherwise. When the patch size doesn't divide the tile height (224 in 512), the last row of a
+    # band runs into the next tile row, whose tiles the next band decodes again
+    tile_size = _wsi_tile_size(wsi)
+    band = (keys[:, 0] * patch_size) // tile_size[1] if tile_size else keys[:, 0]
+    order = np.lexsort((keys[:, 1], band))
+
+    # split each band into runs of columns that are close enough to read together
+    max_run_cols = max(1, max_region_width // patch_size)
+    band_sorted, x_sorted = band[order], keys[order, 1]
+    run_start = np.ones(len(order), dtype=bool)
+    run_start[1:] = (band_sorted[1:] != band_sorted[:-1]) | (np.diff(x_sorted) > max_gap + 1)
+    run_id = np.cumsum(run_start) - 1
+    # cap very wide runs so a single region stays bounded in memory
+    run_col0 = x_sorted[run_start][run_id]
+    run_id = run_id * (x_sorted.max() + 1) + (x_sorted - run_col0) // max_run_cols
+    bounds = np.flatnonzero(np.concatenate(([True], run_id[1:] != run_id[:-1], [True])))
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        run = order[start:stop]
+        # patch rows of the band without any patch in this run are skipped, the rows on either
+        # side of them are read separately
+        run = run[np.argsort(keys[run, 0], kind='stable')]
+        row_breaks = np.flatnonzero(np.diff(keys[run, 0]) > 1) + 1
+        for group in np.split(run, row_breaks):
+            y_min, x_min = keys[group].min(axis=0)
+            y_max, x_max = keys[group].max(axis=0)
+
+            # one read for the bounding box of the rows, the patches are sliced out as views
+            region = wsi.read_region(location=(int(x_min * patch_size), int(y_min * patch_size)), level=0,
+                                     size=(int((x_max - x_min + 1) * patch_size), int((y_max - y_min + 1) * patch_size)))
+            region = np.asarray(region)
+            if region.dtype != np.uint8:
+                region = region.astype(np.uint8)
+            for i in group.tolist():
+                y_off = (keys[i, 0] - y_min) * patch_size
+                x_off = (keys[i, 1] - x_min) * patch_size
+                yield i, region[y_off:y_off + patch_size, x_off:x_off + patch_size]
+
+# matches each patch id (y_patch_idx, x_patch_idx) to the actual patch
+def match_patch_id_to_PIL(sdata, wsi, patch_bins, patch_size=224, log_file=None, reader='tiled'):
+    '''
+    Input:
+    sdata: spatialdata object
+    wsi: whole slide image the cells were binned on
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    patch_size: size of the patch
+    reader: 'tiled' reads neighbouring patches as one region and keeps numpy views,
+    'patch' reads every patch on its own into a PIL image
+
+    Output:
+    patch_id_to_pil: a dict that maps each patch id (y_patch_idx, x_patch_idx) to the actual patch,
+    as a PIL image or a (patch_size, patch_size, 3) uint8 array depending on reader
+    '''
+    # define the location of every patch for read_region
+    x_loc = patch_bins.keys[:, 1] * patch_size
+    y_loc = patch_bins.keys[:, 0] * patch_size
+
+    # check which patches are within the bounds of the image
+    in_bounds = (x_loc >= 0) & (x_loc + patch_size <= wsi.width) & (y_loc >= 0) & (y_loc + patch_size <= wsi.height)
+    if log_file is not None and not in_bounds.all():
+        with _log_handle(log_file) as f:
+            for x, y in zip(x_loc[~in_bounds].tolist(), y_loc[~in_bounds].tolist()):
+                f.write(f"Patch ({x}, {y}) with dimension {patch_size} is out of bounds. Skipped. \n")
+
+    # initialize a dict to image by patch id
+    # {(y_patch_idx, x_patch_idx): PIL image or array}
+    patch_id_to_pil = dict()
+    keys = patch_bins.keys[in_bounds]
+    if reader == 'tiled':
+        for i, patch_np in iter_patch_regions(wsi, keys, patch_size=patch_size):
+            patch_id_to_pil[tuple(keys[i].tolist())] = patch_np
+
+    elif reader == 'patch':
+        from PIL import Image
+        for patch_key, x, y in zip(map(tuple, keys.tolist()), x_loc[in_bounds].tolist(), y_loc[in_bounds].tolist()):
+            # obtain the patch and store in dict
+            patch_np = wsi.read_region(location=(x, y), level=0, size=(patch_size, patch_size))
+            patch_id_to_pil[patch_key] = Image.fromarray(patch_np.astype(np.uint8))
+
+    else:
+        raise ValueError(f"Unknown reader: {reader}")
+
+    # collect stats
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            f.write(f"Number of patches with valid images: {len(patch_id_to_pil)}\n")
+
+    return patch_id_to_pil
+
+# row of every binned cell in the expression table, -1 if it has no expression
+def expr_rows(expr_data, patch_bins):
+    import pandas as pd
+    return pd.Index(expr_data.obs['instance_id']).get_indexer(patch_bins.cell_ids)
+
+# aggregates the expression of the cells in every patch with one sparse matmul
+def aggregate_patch_expr(expr_data, patch_bins, stats=('mean',), rows=None):
+    '''
+    Input:
+    expr_data: anndata table whose obs['instance_id'] holds the cell ids
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    stats: any of 'mean', 'sum', 'count', 'var'
+    rows: optional row of every cell of patch_bins in expr_data (-1 if absent), from expr_rows
+
+    Output:
+    patch_stats: a dict that maps each stat to an array aligned with patch_bins.keys,
+    (n_patches, n_genes) for 'mean', 'sum' and 'var', (n_patches,) for 'count' (cells with expression)
+    '''
+    import scipy.sparse as sp
+    unknown = set(stats) - {'mean', 'sum', 'count', 'var'}
+    if unknown:
+        raise ValueError(f"Unknown expression stats: {sorted(unknown)}")
+
+    X = expr_data.X
+    dtype = np.result_type(X.dtype, np.float32)
+
+    # locate every binned cell in the expression table once, -1 if it has no expression
+    if rows is None:
+        rows = expr_rows(expr_data, patch_bins)
+    patch_idx = np.repeat(np.arange(patch_bins.n_patches), patch_bins.counts)
+    found = rows >= 0
+
+    # (n_patches, n_cells) 0/1 matrix assigning each expression row to its patch
+    assign = sp.csr_matrix((np.ones(np.count_nonzero(found), dtype=dtype), (patch_idx[found], rows[found])),
+                           shape=(patch_bins.n_patches, expr_data.n_obs))
+    count = np.asarray(assign.sum(axis=1)).ravel()
+
+    def _dense(m):
+        return m.toarray() if sp.issparse(m) else np.asarray(m)
+
+    patch_stats = dict()
+    if 'count' in stats:
+        patch_stats['count'] = count.astype(np.int64)
+    if not {'mean', 'sum', 'var'} & set(stats):
+        return patch_stats
+
+    # sums stay sparse x sparse until the (n_patches, n_genes) result
+    sums = _dense(assign @ X).astype(dtype, copy=False)
+    denom = np.maximum(count, 1)[:, None]
+    mean = sums / denom
+    if 'sum' in stats:
+        patch_stats['sum'] = sums
+    if 'mean' in stats:
+        patch_stats['mean'] = mean
+    if 'var' in stats:
+        sq = X.multiply(X) if sp.issparse(X) else np.square(X)
+        sq_sums = _dense(assign @ sq).astype(dtype, copy=False)
+        patch_stats['var'] = np.maximum(sq_sums / denom - np.square(mean), 0)
+
+    return patch_stats
+
+# derives the aggregates of a coarse grid from those of a finer grid nested in it
+def coarsen_patch_stats(fine_bins, fine_stats, coarse_bins, factor):
+    '''
+    Input:
+    fine_bins: PatchBins of the finer grid
+    fine_stats: aggregate_patch_expr output for fine_bins, with 'sum' and 'count'
+    coarse_bins: PatchBins of the same cells binned with patch size factor * fine patch size
+    factor: integer ratio of the coarse to the fine patch size
+
+    Output:
+    patch_stats: 'sum', 'count' and 'mean' aligned with coarse_bins.keys
+    '''
+    import scipy.sparse as sp
+    # every fine patch lies in exactly one coarse patch, and both key sets are sorted row-major,
+    # so the sorted unique parents line up with the coarse keys
+    parent_keys, parent = np.unique(np.floor_divide(fine_bins.keys, factor), axis=0, return_inverse=True)
+    parent = parent.ravel()
+    if not np.array_equal(parent_keys, coarse_bins.keys):
+        raise ValueError("coarse_bins does not nest the fine grid")
+
+    n_coarse = coarse_bins.n_patches
+    assign = sp.csr_matrix((np.ones(len(parent), dtype=fine_stats['sum'].dtype), (parent, np.arange(len(parent)))),
+                           shape=(n_coarse, len(parent)))
+    sums = assign @ fine_stats['sum']
+    count = np.bincount(parent, weights=fine_stats['count'], minlength=n_coarse).astype(np.int64)
+    mean = (sums / np.maximum(count, 1)[:, None]).astype(sums.dtype, copy=False)
+    return {'sum': sums, 'count': count, 'mean': mean}
+
+# matches each patch id (y_patch_idx, x_patch_idx) to the average expression of cells in that patch
+def match_patch_id_to_expr(sdata, patch_bins, patch_id_to_pil, log_file=None, agg_mode='sparse', patch_stats=None):
+    '''
+    Input:
+    sdata: spatialdata object
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    patch_id_to_pil: a dict that maps each patch id (y_patch_idx, x_patch_idx) to the actual patch
+    agg_mode: 'sparse' aggregates all patches in one sparse matmul, 'subset' slices the table patch by patch
+    patch_stats: optional precomputed 'mean' and 'count' for patch_bins (sparse mode only)
+
+    Output:
+    patch_bins: the PatchBins restricted to patches with both an image and expression data
+    patch_id_to_pil: the same dict with patches without expression data removed
+    patch_id_to_expression: a dict that maps each patch id (y_patch_idx, x_patch_idx) to the average expression
+    of cells in that patch, stored as (460,)
+    '''
+
+    # get the expression data
+    expr_data = sdata['table']
+
+    patch_keys = list(map(tuple, patch_bins.keys.tolist()))
+    has_pil = np.array([patch_key in patch_id_to_pil for patch_key in patch_keys], dtype=bool)
+
+    # a patch is usable only if some of its cells have expression information,
+    # and it wasn't omitted at the boundary during the PIL step
+    patch_id_to_expr = dict()
+    if agg_mode == 'sparse':
+        if patch_stats is None:
+            patch_stats = aggregate_patch_expr(expr_data, patch_bins, stats=('mean', 'count'))
+        has_expr = patch_stats['count'] > 0
+        keep = has_expr & has_pil
+        for i in np.flatnonzero(keep):
+            patch_id_to_expr[patch_keys[i]] = patch_stats['mean'][i]
+
+    elif agg_mode == 'subset':
+        # locate every binned cell in the expression table once, -1 if it has no expression
+        rows = expr_rows(expr_data, patch_bins)
+        has_expr = np.zeros(patch_bins.n_patches, dtype=bool)
+        if len(rows):
+            has_expr = np.add.reduceat(rows >= 0, patch_bins.offsets[:-1]) > 0
+        keep = has_expr & has_pil
+        for i in np.flatnonzero(keep):
+            # expression rows of the cells in this patch, (n_cells_in_this_patch, 460)
+            patch_rows = rows[patch_bins.offsets[i]:patch_bins.offsets[i + 1]]
+            patch_rows = patch_rows[patch_rows >= 0]
+
+            # get average expression vector
+            patch_id_to_expr[patch_keys[i]] = np.asarray(expr_data.X[patch_rows].mean(axis=0)).ravel()
+
+    else:
+        raise ValueError(f"Unknown agg_mode: {agg_mode}")
+
+    # process previous containers to remove empty patches
+    for i in np.flatnonzero(~has_expr & has_pil):
+        del patch_id_to_pil[patch_keys[i]]
+    patch_bins = subset_patch_bins(patch_bins, keep)
+
+    # collect stats
+    if log_file is not None:
+        cell_counts = patch_bins.counts
+        if agg_mode == 'sparse':
+            avg_expr = patch_stats['mean'][keep].mean(axis=1)
+        else:
+            avg_expr = np.array([np.mean(expr) for expr in patch_id_to_expr.values()])
+        with _log_handle(log_file) as f:
+            if len(avg_expr):
+                f.write(f"Max average expression: {avg_expr.max()}\n")
+                f.write(f"Min average expression: {avg_expr.min()}\n")
+            f.write(f"Deleted {np.count_nonzero(~has_expr)} patches with no cells containing expression information\n")
+            f.write(f"Deleted {np.count_nonzero(has_expr & ~has_pil)} patches that ran out of WSI boundaries\n")
+            f.write(f"Number of remaining patches (which has valid expression data): {len(patch_id_to_expr)}\n")
+            f.write(f"Number of patches with exactly 10 cells: {np.count_nonzero(cell_counts == 10)}\n")
+            f.write(f"Number of patches with at least 10 cells: {np.count_nonzero(cell_counts >= 10)}\n")
+            f.write(f"Number of patches with at least 100 cells: {np.count_nonzero(cell_counts >= 100)}\n")
+
+    return patch_bins, patch_id_to_pil, patch_id_to_expr
+
+# name of the file (pkl) or bundle directory (npy) save_patches writes for a sample
+def output_name(id, output_format='npy'):
+    if output_format == 'pkl':
+        return 'patch_to_expr_' + id + '.pkl'
+    return 'patch_to_expr_' + id
+
+# the pickled format always stores PIL images, whichever reader produced the patch
+def _as_pil(patch):
+    from PIL import Image
+    if isinstance(patch, Image.Image):
+        return patch
+    return Image.fromarray(np.ascontiguousarray(patch, dtype=np.uint8))
+
+# bytes on disk of an output file or bundle directory
+def _output_bytes(path):
+    if osp.isfile(path):
+        return osp.getsize(path)
+    return sum(osp.getsize(osp.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+# logs how fast an output was written and how much smaller it is than the raw patches and expression
+def _log_write(log_file, id, path, n_patches, patch_size, n_genes, seconds):
+    if log_file is None:
+        return
+    written = _output_bytes(path)
+    raw = n_patches * (patch_size * patch_size * 3 + n_genes * 4)
+    with _log_handle(log_file) as f:
+        f.write(f"Saved {id} ({n_patches} patches of {patch_size}): {raw / 2**20:.1f} MB raw -> {written / 2**20:.1f} MB "
+                f"on disk (compression ratio {raw / max(written, 1):.2f}) in {seconds:.2f}s, "
+                f"{raw / 2**20 / max(seconds, 1e-9):.1f} MB/s\n")
+
+# save the patches and their expression data
+def save_patches(sdata, id, patch_bins, patch_id_to_pil, patch_id_to_expr, output_dir, output_format='npy', patch_size=None,
+                 image_encoding='raw', image_quality=90, log_file=None):
+    '''
+    Input:
+    sdata: spatialdata object
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    patch_id_to_pil: a dict that maps each patch id (y_patch_idx, x_patch_idx) to the actual patch
+    patch_id_to_expr: a dict that maps each patch id (y_patch_idx, x_patch_idx) to the average expression
+    output_dir: directory to save the patches
+    output_format: 'npy' writes a memory-mappable bundle (see SQUIDp.data.bundle),
+    'pkl' a pickled list of {'patch_id', 'pil', 'expr'} dicts
+    patch_size: size of the patch, recorded in the bundle metadata
+    image_encoding: 'raw', 'jpeg', 'webp' or 'png' images in the bundle (npy only)
+    image_quality: quality of jpeg and webp images
+    log_file: if given, the write throughput and compression ratio are logged
+
+    Output:
+    None
+    '''
+    # create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    # save
+    file_name = id
+    # keys of patch_bins are already sorted row-major
+    patch_keys = list(map(tuple, patch_bins.keys.tolist()))
+
+    if output_format == 'npy':
+        expr = np.asarray([patch_id_to_expr[patch_id] for patch_id in patch_keys], dtype=np.float32)
+        gene_names = np.asarray(sdata['table'].var_names)
+        if patch_size is None:
+            patch_size = np.asarray(patch_id_to_pil[patch_keys[0]]).shape[0] if patch_keys else 0
+        with PatchBundleWriter(osp.join(output_dir, output_name(file_name, output_format)), len(patch_keys),
+                               patch_size, gene_names, image_encoding=image_encoding, image_quality=image_quality,
+                               id=file_name) as writer:
+            writer.write(0, [patch_id_to_pil[patch_id] for patch_id in patch_keys],
+                         expr.reshape(len(patch_keys), len(gene_names)), patch_bins.keys, patch_bins.counts)
+
+    elif output_format == 'pkl':
+        data = []
+        for patch_id in patch_keys:
+            data.append({
+                'patch_id': patch_id,
+                'pil': _as_pil(patch_id_to_pil[patch_id]),
+                'expr': patch_id_to_expr[patch_id]
+            })
+        # written atomically so a crash never leaves a truncated pickle behind
+        with atomic_open(osp.join(output_dir, output_name(file_name, output_format)), 'wb') as f:
+            pickle.dump(data, f)
+
+    else:
+        raise ValueError(f"Unknown output_format: {output_format}")
+
+    if patch_size is None:
+        patch_size = np.asarray(patch_id_to_pil[patch_keys[0]]).shape[0] if patch_keys else 0
+    _log_write(log_file, file_name, osp.join(output_dir, output_name(file_name, output_format)), len(patch_keys),
+               patch_size, sdata['table'].n_vars, time.perf_counter() - start)
+    return
+
+# saves slides on a background thread, so writing slide k overlaps loading and processing slide k + 1
+class AsyncWriter:
+    '''
+    max_pending: jobs queued or running before submit blocks, every pending job holds a slide's patches in memory
+    log_file: path the jobs log to, the slide's own log handle is closed by the time they run
+    '''
+    def __init__(self, max_pending=1, log_file=None):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="squidp_writer")
+        self.max_pending = max_pending
+        self.log_file = log_file
+        self.jobs = dict()
+
+    def _running(self):
+        return [future for futures in self.jobs.values() for future in futures if not future.done()]
+
+    def submit(self, id, fn, *args, **kwargs):
+        # backpressure, wait for the oldest job before queueing another slide
+        running = self._running()
+        while len(running) >= self.max_pending:
+            wait(running[:1])
+            running = self._running()
+        self.jobs.setdefault(id, []).append(self.executor.submit(fn, *args, **kwargs))
+
+    def finished(self):
+        '''
+        Returns (id, error) for every slide whose jobs are all done, error is None or the
+        formatted traceback of the first failed job, and forgets those slides.
+        '''
+        done = []
+        for id, futures in list(self.jobs.items()):
+            if all(future.done() for future in futures):
+                errors = [future.exception() for future in futures if future.exception() is not None]
+                error = "".join(traceback.format_exception(errors[0])) if errors else None
+                done.append((id, error))
+                del self.jobs[id]
+        return done
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        return self.finished()
+
+# summary statistics of the patches written so far, updated batch by batch
+class RunningPatchStats:
+    def __init__(self):
+        self.n_patches = 0
+        self.n_cells_eq_10 = 0
+        self.n_cells_ge_10 = 0
+        self.n_cells_ge_100 = 0
+        self.max_avg_expr = -np.inf
+        self.min_avg_expr = np.inf
+
+    def update(self, cell_counts, expr):
+        if len(cell_counts) == 0:
+            return
+        avg_expr = expr.mean(axis=1)
+        self.n_patches += len(cell_counts)
+        self.n_cells_eq_10 += int(np.count_nonzero(cell_counts == 10))
+        self.n_cells_ge_10 += int(np.count_nonzero(cell_counts >= 10))
+        self.n_cells_ge_100 += int(np.count_nonzero(cell_counts >= 100))
+        self.max_avg_expr = max(self.max_avg_expr, float(avg_expr.max()))
+        self.min_avg_expr = min(self.min_avg_expr, float(avg_expr.min()))
+
+    def write(self, f):
+        if self.n_patches:
+            f.write(f"Max average expression: {self.max_avg_expr}\n")
+            f.write(f"Min average expression: {self.min_avg_expr}\n")
+        f.write(f"Number of remaining patches (which has valid expression data): {self.n_patches}\n")
+        f.write(f"Number of patches with exactly 10 cells: {self.n_cells_eq_10}\n")
+        f.write(f"Number of patches with at least 10 cells: {self.n_cells_ge_10}\n")
+        f.write(f"Number of patches with at least 100 cells: {self.n_cells_ge_100}\n")
+
+# reads, aggregates and writes the patches of a slide batch by batch, in row-major order
+def stream_patches(sdata, id, wsi, patch_bins, output_dir, patch_size=224, log_file=None, reader='tiled', batch_mb=256,
+                   image_encoding='raw', image_quality=90):
+    '''
+    Input:
+    sdata: spatialdata object
+    wsi: whole slide image the cells were binned on
+    patch_bins: a PatchBins that groups the cell ids by patch id (y_patch_idx, x_patch_idx)
+    output_dir: directory to save the bundle
+    reader: see match_patch_id_to_PIL
+    batch_mb: upper bound on the images of one batch held in memory
+    image_encoding, image_quality: see save_patches
+
+    Only one batch of images is in memory at a time, the rest lives in the
+    bundle being written (see SQUIDp.data.bundle). Patches are kept or dropped
+    by the same rules as match_patch_id_to_expr, and the expression is always
+    aggregated with sparse matmuls, one per batch.
+
+    Output:
+    patch_bins: the PatchBins restricted to the patches that were written
+    bundle_path: path of the written bundle
+    '''
+    expr_data = sdata['table']
+    os.makedirs(output_dir, exist_ok=True)
+
+    # which patches are kept is known before any pixel is read, so the bundle can be preallocated
+    rows = expr_rows(expr_data, patch_bins)
+    has_expr = np.zeros(patch_bins.n_patches, dtype=bool)
+    if len(rows):
+        has_expr = np.add.reduceat(rows >= 0, patch_bins.offsets[:-1]) > 0
+    x_loc = patch_bins.keys[:, 1] * patch_size
+    y_loc = patch_bins.keys[:, 0] * patch_size
+    in_bounds = (x_loc >= 0) & (x_loc + patch_size <= wsi.width) & (y_loc >= 0) & (y_loc + patch_size <= wsi.height)
+    keep = has_expr & in_bounds
+    rows = rows[np.repeat(keep, patch_bins.counts)]
+    patch_bins = subset_patch_bins(patch_bins, keep)
+
+    batch_size = max(1, int(batch_mb * 2**20) // (patch_size * patch_size * 3))
+    running = RunningPatchStats()
+    timings = {'read': 0.0, 'aggregate': 0.0, 'write': 0.0}
+    bundle_path = osp.join(output_dir, output_name(id, 'npy'))
+    with PatchBundleWriter(bundle_path, patch_bins.n_patches, patch_size, np.asarray(expr_data.var_names),
+                           image_encoding=image_encoding, image_quality=image_quality, id=id) as writer:
+        for start in range(0, patch_bins.n_patches, batch_size):
+            stop = min(start + batch_size, patch_bins.n_patches)
+            batch_bins = slice_patch_bins(patch_bins, start, stop)
+
+            t = time.perf_counter()
+            images = [None] * batch_bins.n_patches
+            if reader == 'tiled':
+                for i, patch_np in iter_patch_regions(wsi, batch_bins.keys, patch_size=patch_size):
+                    images[i] = patch_np
+            elif reader == 'patch':
+                for i, (y_idx, x_idx) in enumerate(batch_bins.keys.tolist()):
+                    images[i] = wsi.read_region(location=(x_idx * patch_size, y_idx * patch_size), level=0,
+                                                size=(patch_size, patch_size))
+            else:
+                raise ValueError(f"Unknown reader: {reader}")
+            timings['read'] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            batch_rows = rows[patch_bins.offsets[start]:patch_bins.offsets[stop]]
+            expr = aggregate_patch_expr(expr_data, batch_bins, stats=('mean',), rows=batch_rows)['mean']
+            running.update(batch_bins.counts, expr)
+            timings['aggregate'] += time.perf_counter() - t
+
+            t = time.perf_counter()
+            writer.write(start, images, expr, batch_bins.keys, batch_bins.counts)
+            writer.flush()
+            timings['write'] += time.perf_counter() - t
+            del images
+
+    # collect stats
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            if not in_bounds.all():
+                for x, y in zip(x_loc[~in_bounds].tolist(), y_loc[~in_bounds].tolist()):
+                    f.write(f"Patch ({x}, {y}) with dimension {patch_size} is out of bounds. Skipped. \n")
+            f.write(f"Deleted {np.count_nonzero(~has_expr)} patches with no cells containing expression information\n")
+            f.write(f"Deleted {np.count_nonzero(has_expr & ~in_bounds)} patches that ran out of WSI boundaries\n")
+            running.write(f)
+            f.write(f"Streamed {patch_bins.n_patches} patches in batches of {batch_size} "
+                    f"(read {timings['read']:.1f}s, aggregate {timings['aggregate']:.1f}s, write {timings['write']:.1f}s)\n")
+        _log_write(log_file, id, bundle_path, patch_bins.n_patches, patch_size, expr_data.n_vars, timings['write'])
+
+    return patch_bins, bundle_path
+
+# reads the per-slide completion manifest of output_dir
+# {'samples': {id: {patch_size: {'fingerprint', 'outputs', 'settings', 'finished'}}}}
+def load_manifest(output_dir):
+    manifest_path = osp.join(output_dir, MANIFEST_NAME)
+    if not osp.exists(manifest_path):
+        return {'samples': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_manifest(output_dir, manifest):
+    with atomic_open(osp.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+# a slide is done if it was processed from the same inputs with the same patch size and
+# settings that change the patches, into the same outputs, and those outputs still exist
+# (bundles must also still hold that patch size, a later run at another size overwrites them)
+def is_complete(manifest, output_dir, id, patch_size, fingerprint, outputs, settings=None):
+    entry = manifest['samples'].get(id, {}).get(str(patch_size))
+    if entry is None or entry['fingerprint'] != fingerprint or entry['outputs'] != list(outputs):
+        return False
+    if entry.get('settings', {}) != (settings or {}):
+        return False
+    for name in entry['outputs']:
+        path = osp.join(output_dir, name)
+        if not osp.exists(path):
+            return False
+        if is_bundle(path) and read_meta(path).get('patch_size') != patch_size:
+            return False
+    return True
+
+def record_complete(manifest, id, patch_size, fingerprint, outputs, settings=None):
+    entries = manifest['samples'].setdefault(id, {})
+    # single-size runs write every size to the same outputs, only the last one is there now
+    for size in [size for size, entry in entries.items() if set(entry['outputs']) & set(outputs)]:
+        del entries[size]
+    entries[str(patch_size)] = {
+        'fingerprint': fingerprint,
+        'outputs': list(outputs),
+        'settings': settings or {},
+        'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+# where the outputs of one patch size go, side by side in patch_<size> folders when several sizes are extracted
+def scale_dirs(output_dir, plot_dir, patch_size, multi_scale):
+    if not multi_scale:
+        return output_dir, plot_dir
+    return osp.join(output_dir, f"patch_{patch_size}"), osp.join(plot_dir, f"patch_{patch_size}")
+
+# processes one loaded slide end to end
+def process_slide(st, output_dir, plot_dir, patch_size=224, log_file=None, expr_agg='sparse', wsi_reader='tiled',
+                  output_format='npy', profiler=None, stream=False, stream_batch_mb=256, min_tissue_frac=0.0,
+                  image_encoding='raw', image_quality=90, writer=None):
+    '''
+    Input:
+    st: HESTData object yielded by iter_hest
+    output_dir: directory to save the patches
+    plot_dir: directory to save the plots
+    patch_size: size of the patch, or a list of sizes that all reuse the same loaded slide
+    expr_agg, wsi_reader, output_format: see match_patch_id_to_expr, match_patch_id_to_PIL and save_patches
+    profiler: optional StageProfiler that times every stage
+    stream: read, aggregate and write the patches in bounded batches with stream_patches (npy only)
+    stream_batch_mb: memory bound of one streamed batch of images
+    min_tissue_frac: if above 0, patches with less tissue in the thumbnail mask are dropped before reading
+    image_encoding, image_quality: see save_patches
+    writer: optional AsyncWriter that saves the patches in the background (ignored when streaming)
+
+    Output:
+    None
+    '''
+    id = st.meta['id']
+    with stage(profiler, 'to_spatial_data'):
+        sdata = st.to_spatial_data()
+    wsi = st.wsi
+
+    # finest first, so coarser sizes that nest can reuse its sums
+    patch_sizes = sorted(set(np.atleast_1d(patch_size).tolist()))
+    multi_scale = len(patch_sizes) > 1
+    centroids = cell_centroids(sdata)
+    size_to_agg = dict()
+
+    # one mask per slide, shared by every patch size
+    if min_tissue_frac > 0:
+        with stage(profiler, 'tissue_mask'):
+            mask, mask_scale, threshold = tissue_mask(wsi)
+            os.makedirs(plot_dir, exist_ok=True)
+            save_tissue_mask(mask, threshold, id, plot_dir, log_file=log_file)
+
+    for size in patch_sizes:
+        size_output_dir, _ = scale_dirs(output_dir, plot_dir, size, multi_scale)
+
+        with stage(profiler, 'bin', patch_size=size):
+            patch_bins = get_cell_ids_in_patch(sdata, patch_size=size, log_file=log_file, centroids=centroids)
+        tissue_bins = patch_bins
+        if min_tissue_frac > 0:
+            with stage(profiler, 'tissue_filter', patch_size=size):
+                tissue_bins, tissue_keep = filter_tissue_patches(patch_bins, mask, mask_scale, patch_size=size,
+                                                                 min_tissue_frac=min_tissue_frac, log_file=log_file)
+
+        if stream:
+            if output_format != 'npy':
+                raise ValueError("Streaming writes .npy bundles only")
+            with stage(profiler, 'stream', patch_size=size):
+                patch_bins, bundle_path = stream_patches(sdata, id, wsi, tissue_bins, size_output_dir, patch_size=size,
+                                                         log_file=log_file, reader=wsi_reader, batch_mb=stream_batch_mb,
+                                                         image_encoding=image_encoding, image_quality=image_quality)
+            continue
+
+        patch_stats = None
+        if expr_agg == 'sparse':
+            with stage(profiler, 'aggregate', patch_size=size):
+                nested = [fine for fine in size_to_agg if size % fine == 0]
+                if nested:
+                    fine = max(nested)
+                    patch_stats = coarsen_patch_stats(*size_to_agg[fine], patch_bins, size // fine)
+                    if log_file is not None:
+                        with _log_handle(log_file) as f:
+                            f.write(f"Derived patch size {size} expression from patch size {fine}\n")
+                else:
+                    patch_stats = aggregate_patch_expr(sdata['table'], patch_bins, stats=('mean', 'sum', 'count'))
+            # coarser sizes nest the full grid, so the aggregates are kept from before the tissue filter
+            if multi_scale:
+                size_to_agg[size] = (patch_bins, patch_stats)
+            if min_tissue_frac > 0:
+                patch_stats = {name: values[tissue_keep] for name, values in patch_stats.items()}
+        patch_bins = tissue_bins
+
+        with stage(profiler, 'read_wsi', patch_size=size):
+            patch_id_to_pil = match_patch_id_to_PIL(sdata, wsi, patch_bins, patch_size=size, log_file=log_file, reader=wsi_reader)
+        with stage(profiler, 'match_expr', patch_size=size):
+            patch_bins, patch_id_to_pil, patch_id_to_expr = match_patch_id_to_expr(sdata, patch_bins, patch_id_to_pil, log_file=log_file,
+                                                                                   agg_mode=expr_agg, patch_stats=patch_stats)
+        with stage(profiler, 'save', patch_size=size, background=writer is not None):
+            if writer is not None:
+                # only the table is handed over, so the rest of the slide can be freed while the job waits
+                writer.submit(id, save_patches, {'table': sdata['table']}, id, patch_bins, patch_id_to_pil, patch_id_to_expr,
+                              output_dir=size_output_dir, output_format=output_format, patch_size=size,
+                              image_encoding=image_encoding, image_quality=image_quality, log_file=writer.log_file)
+            else:
+                save_patches(sdata, id, patch_bins, patch_id_to_pil, patch_id_to_expr, output_dir=size_output_dir,
+                             output_format=output_format, patch_size=size, image_encoding=image_encoding,
+                             image_quality=image_quality, log_file=log_file)
+        del patch_id_to_pil, patch_id_to_expr
+
+    if log_file is not None:
+        with _log_handle(log_file) as f:
+            f.write(f"Finished processing {id}\n")
+            f.write("\n")
+
+# loads and processes a single sample id, never raises so one bad slide can't stop the others
+def process_sample(id, hest_data_dir, log_file=None, pstats_file=None, load_transcripts=False, **slide_kwargs):
+    '''
+    Input:
+    id: HEST sample id
+    hest_data_dir: directory to downloaded dataset
+    log_file: log file for this sample, per-stage timings go to the .jsonl next to it
+    pstats_file: if given, the sample runs under cProfile and the stats are dumped there
+    load_transcripts: load the full sample (transcripts and segmentation shapes) through iter_hest,
+    by default only the centroids, expression table and WSI handle are read with load_slide
+    slide_kwargs: forwarded to process_slide
+
+    Output:
+    (id, error, wall_s) where error is None on success and the formatted traceback otherwise
+    '''
+    start = time.perf_counter()
+    profiler = StageProfiler(id, jsonl_file=_jsonl_path(log_file)) if log_file is not None else None
+    try:
+        # one handle for every stats write of this slide
+        with maybe_cprofile(pstats_file), (open(log_file, 'a') if log_file is not None else nullcontext()) as log:
+            with stage(profiler, 'read_inputs'):
+                if load_transcripts:
+                    from hest import iter_hest
+                    sts = list(iter_hest(hest_data_dir, id_list=[id], load_transcripts=True))
+                else:
+                    from SQUIDp.slide import load_slide
+                    sts = [load_slide(hest_data_dir, id)]
+                    stats = sts[0].load_stats
+                    if log is not None:
+                        log.write(f"Loaded {id} in {stats['load_s']:.1f}s ({stats['rss_mb']:+.0f} MB RSS) without transcripts "
+                                  f"or segmentation shapes, {stats['skipped_files']} files left unread: "
+                                  f"{stats['skipped_disk_mb']:.0f} MB on disk, ~{stats['skipped_memory_mb']:.0f} MB in memory\n")
+            for st in sts:
+                process_slide(st, log_file=log, profiler=profiler, **slide_kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    wall_s = time.perf_counter() - start
+    if profiler is not None:
+        with open(profiler.jsonl_file, 'a') as f:
+            f.write(json.dumps({'id': id, 'stage': 'total', 'wall_s': round(wall_s, 4),
+                                'failed': error is not None}) + "\n")
+    return id, error, wall_s
+
+# appends a worker's per-sample logs (text and json lines) to the main logs and removes them
+def _merge_log(log_file, sample_log):
+    for src_path, dst_path in [(sample_log, log_file), (_jsonl_path(sample_log), _jsonl_path(log_file))]:
+        if osp.exists(src_path):
+            with open(src_path, 'r') as src, open(dst_path, 'a') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(src_path)
+
+# processes every sample id, in this process or farmed out to a pool of workers
+def run_samples(id_list, hest_data_dir, log_file, workers=1, max_inflight=None, on_success=None, profile_dir=None,
+                async_write=False, **slide_kwargs):
+    '''
+    Input:
+    id_list: sample ids to process
+    hest_data_dir: directory to downloaded dataset
+    log_file: main log file, per-worker logs are merged into it as slides finish
+    workers: number of worker processes, 1 processes the slides in this process
+    max_inflight: number of slides submitted to the pool at once, defaults to workers
+    on_success: called with the sample id in this process after each slide that finished
+    profile_dir: if given, every slide runs under cProfile and the stats of the slowest one are kept there
+    async_write: with a single worker, save each slide on a background thread while the next one loads
+    (each pool worker processes a single slide, so there is nothing to overlap with more workers)
+    slide_kwargs: forwarded to process_slide
+
+    Output:
+    failed: a dict that maps each failed sample id to its traceback
+    '''
+    failed = dict()
+    wall_times = dict()
+
+    def _pstats_file(id):
+        return osp.join(profile_dir, f"{id}.pstats") if profile_dir is not None else None
+
+    def _record(id, error, wall_s=None):
+        if wall_s is not None:
+            wall_times[id] = wall_s
+        if id in failed:
+            return
+        if error is None:
+            if on_success is not None:
+                on_success(id)
+        else:
+            failed[id] = error
+            with open(log_file, 'a') as f:
+                f.write(f"Failed processing {id}\n")
+                f.write(error)
+                f.write("\n")
+
+    if workers <= 1:
+        # a slide written in the background is recorded once its writes are done
+        writer = AsyncWriter(log_file=log_file) if async_write else None
+        for id in id_list:
+            id, error, wall_s = process_sample(id, hest_data_dir, log_file=log_file, pstats_file=_pstats_file(id),
+                                               writer=writer, **slide_kwargs)
+            if writer is None or error is not None:
+                _record(id, error, wall_s)
+            else:
+                wall_times[id] = wall_s
+                if id not in writer.jobs:
+                    _record(id, None)
+            if writer is not None:
+                for done in writer.finished():
+                    _record(*done)
+        if writer is not None:
+            for done in writer.close():
+                _record(*done)
+        _keep_slowest_profile(profile_dir, wall_times, log_file)
+        return failed
+
+    # each worker writes its own log, merged into the main log once the slide is done
+    worker_log_dir = log_file[:-len('.txt')] + "_workers"
+    os.makedirs(worker_log_dir, exist_ok=True)
+
+    # a fresh process per slide hands the memory of finished slides back to the os,
+    # and at most max_inflight slides are loaded at any time
+    max_inflight = max_inflight or workers
+    pending = dict()
+    ids = iter(id_list)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'), max_tasks_per_child=1) as pool:
+        while True:
+            for id in ids:
+                sample_log = osp.join(worker_log_dir, f"{id}.txt")
+                pending[pool.submit(process_sample, id, hest_data_dir, log_file=sample_log, pstats_file=_pstats_file(id),
+                                    **slide_kwargs)] = (id, sample_log)
+                if len(pending) >= max_inflight:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                id, sample_log = pending.pop(future)
+                _merge_log(log_file, sample_log)
+                try:
+                    _record(*future.result())
+                except Exception:
+                    # the worker itself died, e.g. killed for running out of memory
+                    _record(id, traceback.format_exc())
+
+    shutil.rmtree(worker_log_dir, ignore_errors=True)
+    _keep_slowest_profile(profile_dir, wall_times, log_file)
+    return failed
+
+# keeps the cProfile stats of the slowest slide and drops the rest
+def _keep_slowest_profile(profile_dir, wall_times, log_file):
+    if profile_dir is None or not wall_times:
+        return
+    slowest = max(wall_times, key=wall_times.get)
+    for id in wall_times:
+        if id != slowest and osp.exists(osp.join(profile_dir, f"{id}.pstats")):
+            os.remove(osp.join(profile_dir, f"{id}.pstats"))
+    with open(log_file, 'a') as f:
+        f.write(f"Slowest slide: {slowest} ({wall_times[slowest]:.1f}s), "
+                f"cProfile stats in {osp.join(profile_dir, slowest + '.pstats')}\n")
+
+# runs this script for all data at hand
+def main():
+    parser = argparse.ArgumentParser(description="Process downloaded HEST 1k")
+    parser.add_argument('--hest_data_dir', type=str, required=True, help="Directory to downloaded dataset")
+    parser.add_argument('--output_dir', type=str, required=True, help="Directory to save the output patches and logs")
+    parser.add_argument('--patch_size', type=int, nargs='+', default=[224],
+                        help="Size of the patches to extract, several sizes are extracted from one load of each slide")
+    parser.add_argument('--expr_agg', type=str, default='sparse', choices=['sparse', 'subset'],
+                        help="How to average expression per patch, one sparse matmul or the per-patch subset")
+    parser.add_argument('--wsi_reader', type=str, default='tiled', choices=['tiled', 'patch'],
+                        help="Read neighbouring patches as one WSI region, or every patch on its own")
+    parser.add_argument('--output_format', type=str, default='npy', choices=['npy', 'pkl'],
+                        help="Memory-mappable .npy bundle per slide, or the older pickled list of PIL images")
+    parser.add_argument('--workers', type=int, default=1, help="Number of slides to process in parallel")
+    parser.add_argument('--max_inflight', type=int, default=None,
+                        help="Maximum number of slides loaded at once across workers, defaults to --workers")
+    parser.add_argument('--force', action='store_true', help="Reprocess slides even if the manifest marks them complete")
+    parser.add_argument('--profile', action='store_true',
+                        help="Run every slide under cProfile and keep the .pstats of the slowest one")
+    parser.add_argument('--stream', action='store_true',
+                        help="Read, aggregate and write patches in bounded batches instead of holding a whole slide")
+    parser.add_argument('--stream_batch_mb', type=int, default=256,
+                        help="Memory bound in MB of one batch of patch images with --stream")
+    parser.add_argument('--min_tissue_frac', type=float, default=0.0,
+                        help="Drop patches with less tissue than this in a thumbnail tissue mask, 0 keeps every patch")
+    parser.add_argument('--image_encoding', type=str, default='raw', choices=['raw', 'jpeg', 'webp', 'png'],
+                        help="Store bundle images as a raw uint8 array or compressed one by one")
+    parser.add_argument('--image_quality', type=int, default=90, help="Quality of jpeg and webp images")
+    parser.add_argument('--async_write', action='store_true',
+                        help="Save each slide on a background thread while the next one loads (with --workers 1)")
+    parser.add_argument('--plots', type=str, default='full', choices=['none', 'summary', 'full'],
+                        help="QC plots rendered from the saved bundles after all slides are processed, "
+                             "'none' defers them to squidp-qc")
+    parser.add_argument('--meta_path', type=str, default=None,
+                        help="Local HEST metadata cache, defaults to $SQUIDP_META_PATH or ~/.cache/SQUIDp")
+    parser.add_argument('--load_transcripts', action='store_true',
+                        help="Load each sample in full with iter_hest, transcripts and segmentation shapes included")
+
+    # get args
+    args = parser.parse_args()
+    output_dir = auto_expand(args.output_dir)
+    hest_data_dir = auto_expand(args.hest_data_dir)
+    patch_sizes = sorted(set(args.patch_size))
+    multi_scale = len(patch_sizes) > 1
+    expr_agg = args.expr_agg
+    wsi_reader = args.wsi_reader
+    output_format = args.output_format
+    if args.stream and output_format != 'npy':
+        parser.error("--stream writes .npy bundles, use --output_format npy")
+    if args.image_encoding != 'raw' and output_format != 'npy':
+        parser.error("--image_encoding applies to .npy bundles, use --output_format npy")
+
+    # create output directories
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    plot_dir = osp.join(output_dir, "plots")
+    log_file = osp.join(output_dir, f"log_{timestamp}.txt")
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(plot_dir, exist_ok=True)
+    with open(log_file, 'a') as f:
+        f.write(f"Log file created at {timestamp}\n")
+        f.write(f"Output directory: {output_dir}\n")
+        f.write(f"Plot directory: {plot_dir}\n")
+        f.write(f"Workers: {args.workers}\n")
+        f.write(f"Stage timings: {_jsonl_path(log_file)}\n")
+        f.write("\n")
+    
+    # establish the ids to process
+    meta_df = load_meta(args.meta_path and auto_expand(args.meta_path))
+    id_list = list(sqd.get_ids(meta_df, TISSUES))
+
+    # outputs of a sample for one patch size, relative to output_dir
+    def _outputs(id, size):
+        size_output_dir, _ = scale_dirs(output_dir, plot_dir, size, multi_scale)
+        return [osp.relpath(osp.join(size_output_dir, output_name(id, output_format)), output_dir)]
+
+    # settings that change which patches are saved, a mismatch reprocesses the slide like changed inputs
+    settings = {'min_tissue_frac': args.min_tissue_frac}
+    if args.min_tissue_frac > 0:
+        settings['tissue_mask'] = TISSUE_MASK_SETTINGS
+    if output_format == 'npy':
+        settings['image_encoding'] = args.image_encoding
+        if args.image_encoding in ('jpeg', 'webp'):
+            settings['image_quality'] = args.image_quality
+
+    # skip slides already processed from the same inputs and settings with every requested patch size
+    hest_data_dir = osp.expanduser(hest_data_dir)
+    manifest = load_manifest(output_dir)
+    input_files = sqd.sample_files(hest_data_dir, id_list)
+    fingerprints = {id: sqd.fingerprint(input_files[id], root=hest_data_dir) for id in id_list}
+    todo_list = [id for id in id_list
+                 if args.force or not all(is_complete(manifest, output_dir, id, size, fingerprints[id], _outputs(id, size),
+                                                      settings) for size in patch_sizes)]
+    with open(log_file, 'a') as f:
+        f.write(f"Skipping {len(id_list) - len(todo_list)} slides already processed with patch sizes {patch_sizes}\n")
+        f.write("\n")
+
+    # recorded after every slide so a crashed run resumes where it stopped
+    def _on_success(id):
+        for size in patch_sizes:
+            record_complete(manifest, id, size, fingerprints[id], _outputs(id, size), settings)
+        write_manifest(output_dir, manifest)
+
+    # main loop
+    profile_dir = osp.join(output_dir, f"profile_{timestamp}") if args.profile else None
+    failed = run_samples(todo_list, hest_data_dir, log_file, workers=args.workers,
+                         max_inflight=args.max_inflight, on_success=_on_success, profile_dir=profile_dir,
+                         output_dir=output_dir, plot_dir=plot_dir, patch_size=patch_sizes, expr_agg=expr_agg, wsi_reader=wsi_reader,
+                         output_format=output_format, stream=args.stream, stream_batch_mb=args.stream_batch_mb,
+                         min_tissue_frac=args.min_tissue_frac, image_encoding=args.image_encoding,
+                         image_quality=args.image_quality, async_write=args.async_write,
+                         load_transcripts=args.load_transcripts)
+
+    with open(log_file, 'a') as f:
+        f.write(f"Processed {len(todo_list) - len(failed)} of {len(todo_list)} slides\n")
+        if failed:
+            f.write(f"Failed slides: {', '.join(failed)}\n")
+
+    # QC plots of the slides processed by this run, as a separate stage over the saved bundles
+    if args.plots != 'none':
+        if output_format != 'npy':
+            with open(log_file, 'a') as f:
+                f.write("QC plots are rendered from .npy bundles, skipped for pkl output\n")
+            return
+        from SQUIDp.qc import plot_bundles
+        jobs = []
+        for id in todo_list:
+            if id in failed:
+                continue
+            for size in patch_sizes:
+                size_output_dir, size_plot_dir = scale_dirs(output_dir, plot_dir, size, multi_scale)
+                jobs.append((osp.join(size_output_dir, output_name(id, output_format)), size_plot_dir))
+
+        def _log(message):
+            with open(log_file, 'a') as f:
+                f.write(message + "\n")
+        plot_bundles(jobs, level=args.plots, workers=max(1, args.workers), log=_log)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import resource
+import cProfile
+from contextlib import contextmanager, nullcontext
+
+def _io_counters():
+    """
+    Bytes read by this process so far: 'read_bytes' hit storage, 'rchar'
+    includes reads served from the page cache. Empty where /proc is missing.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read_bytes': int(fields['read_bytes']), 'rchar': int(fields['rchar'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# highest peak RSS seen before any reset, resetting VmHWM also resets ru_maxrss
+_process_peak_mb = 0.0
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS the kernel reports as VmHWM to the current RSS, so
+    VmHWM is the peak since this call. False where that is not supported.
+    """
+    global _process_peak_mb
+    _process_peak_mb = max(_process_peak_mb, _peak_rss_mb())
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _hwm_mb() is not None
+    except OSError:
+        return False
+
+def _hwm_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def current_rss_mb():
+    """
+    Resident memory of this process right now, the peak where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return _peak_rss_mb()
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, peak RSS and bytes read of each stage of a
+    slide as one JSON line, e.g.
+    {"id": "TENX95", "stage": "read_wsi", "patch_size": 224, "wall_s": 12.1,
+     "cpu_s": 9.8, "rss_start_mb": 2210.4, "rss_end_mb": 2315.9,
+     "peak_rss_mb": 5120.3, "process_peak_rss_mb": 6004.2, "read_mb": 812.4,
+     "rchar_mb": 830.0}
+    peak_rss_mb is the peak within the stage and is left out where the kernel
+    can't reset it; process_peak_rss_mb is the peak since the process started.
+    """
+    def __init__(self, id, jsonl_file=None):
+        self.id = id
+        self.jsonl_file = jsonl_file
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, **fields):
+        io_start = _io_counters()
+        rss_start = current_rss_mb()
+        peak_reset = _reset_peak_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            io_end = _io_counters()
+            record = {'id': self.id, 'stage': name, **fields,
+                      'wall_s': round(time.perf_counter() - wall_start, 4),
+                      'cpu_s': round(time.process_time() - cpu_start, 4),
+                      'rss_start_mb': round(rss_start, 1),
+                      'rss_end_mb': round(current_rss_mb(), 1)}
+            stage_peak = _hwm_mb() if peak_reset else None
+            if stage_peak is not None:
+                record['peak_rss_mb'] = round(stage_peak, 1)
+            record['process_peak_rss_mb'] = round(max(_process_peak_mb, _peak_rss_mb()), 1)
+            if io_start and io_end:
+                record['read_mb'] = round((io_end['read_bytes'] - io_start['read_bytes']) / 2**20, 2)
+                record['rchar_mb'] = round((io_end['rchar'] - io_start['rchar']) / 2**20, 2)
+            self.records.append(record)
+            if self.jsonl_file is not None:
+                with open(self.jsonl_file, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+
+    @property
+    def total_wall_s(self):
+        return sum(record['wall_s'] for record in self.records)
+
+def stage(profiler, name, **fields):
+    """
+    profiler.stage(name) when profiling, a no-op context otherwise.
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, **fields)
+
+@contextmanager
+def maybe_cprofile(pstats_file=None):
+    """
+    Runs the block under cProfile and dumps the stats (readable by pstats,
+    snakeviz or gprof2dot) to pstats_file; does nothing if it is None.
+    """
+    if pstats_file is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(pstats_file)), exist_ok=True)
+        profile.dump_stats(pstats_file)
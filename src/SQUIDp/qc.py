@@ -0,0 +1,190 @@
+# QC plots of processed slides, computed from the saved bundles rather than inline while processing
+import os
+import os.path as osp
+import time
+import argparse
+import traceback
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from SQUIDp.util import auto_expand
+from SQUIDp.data.bundle import load_bundle, find_processed_bundles
+
+PLOT_LEVELS = ['none', 'summary', 'full']
+
+def bundle_qc_stats(bundle, seed=0):
+    '''
+    Input:
+    bundle: a PatchBundle, only its expression, coordinates and cell counts are read
+    seed: seed of the random patches that are shown
+
+    Output:
+    stats: a dict with the per-patch cell counts, mean and sd expression over genes,
+    and the rows of the patches the figures show
+    '''
+    expr = np.asarray(bundle.expr, dtype=np.float64)
+    coords = np.asarray(bundle.coords)
+    n_cells = np.asarray(bundle.n_cells)
+    n_patches, n_genes = expr.shape
+
+    # mean and sd over genes of every patch from one pass of sums
+    sums = expr.sum(axis=1)
+    sq_sums = np.einsum('ij,ij->i', expr, expr)
+    avg_expr = sums / max(n_genes, 1)
+    sd_expr = np.sqrt(np.maximum(sq_sums / max(n_genes, 1) - np.square(avg_expr), 0))
+
+    rng = np.random.default_rng(seed)
+    # approximate center patch, a random one if no patch sits there
+    center = np.round(coords.mean(axis=0)).astype(np.int64)
+    center_rows = np.flatnonzero((coords == center).all(axis=1))
+    center_row = int(center_rows[0]) if len(center_rows) else int(rng.integers(n_patches))
+
+    return {
+        'n_patches': n_patches,
+        'n_cells': n_cells,
+        'avg_expr': avg_expr,
+        'sd_expr': sd_expr,
+        'max_cells_row': int(np.argmax(n_cells)),
+        'min_cells_row': int(np.argmin(n_cells)),
+        'center_row': center_row,
+        'random_rows': rng.choice(n_patches, size=min(3, n_patches), replace=False).tolist(),
+        'max_avg_row': int(np.argmax(avg_expr)),
+        'max_sd_row': int(np.argmax(sd_expr)),
+        'random_expr_row': int(rng.integers(n_patches)),
+    }
+
+def plot_cell_counts(stats, id, plot_dir):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    ax.hist(stats['n_cells'], bins=50)
+    ax.set_xlabel('Number of cells in patch')
+    ax.set_ylabel('Frequency')
+    ax.set_title(f'Distribution of cell counts in patches for {id}')
+    fig.savefig(osp.join(plot_dir, f"cell_counts_per_patch_{id}.png"))
+    plt.close(fig)
+
+def plot_sample_patches(stats, bundle, id, plot_dir):
+    import matplotlib.pyplot as plt
+    coords, n_cells = bundle.coords, stats['n_cells']
+    panels = [("Max cells", stats['max_cells_row']), ("Min cells", stats['min_cells_row']),
+              ("Center patch", stats['center_row'])]
+    panels += [(f"Random patch {i + 1}", row) for i, row in enumerate(stats['random_rows'])]
+
+    fig, axs = plt.subplots(2, 3, figsize=(15, 10))
+    for ax, (title, row) in zip(axs.ravel(), panels):
+        ax.imshow(bundle.images[row])
+        ax.set_title(f"{title}: {n_cells[row]} at {tuple(coords[row].tolist())}")
+    fig.suptitle(f"Sampled patches from {id}", fontsize=16)
+    fig.tight_layout(rect=[0, 0, 1, 0.95])
+    fig.savefig(osp.join(plot_dir, f"sample_patches_viz_{id}.png"))
+    plt.close(fig)
+
+def plot_sample_expression(stats, bundle, id, plot_dir):
+    import matplotlib.pyplot as plt
+    coords, n_cells = bundle.coords, stats['n_cells']
+    max_avg_row, max_sd_row, random_row = stats['max_avg_row'], stats['max_sd_row'], stats['random_expr_row']
+    random_expr = np.asarray(bundle.expr[random_row])
+
+    fig, axs = plt.subplots(2, 2, figsize=(15, 10))
+    axs[0, 0].imshow(bundle.images[max_avg_row])
+    axs[0, 0].set_title(f"Max avg expression: {stats['avg_expr'][max_avg_row]} at {tuple(coords[max_avg_row].tolist())} \n "
+                        f"Number of cells: {n_cells[max_avg_row]}")
+    axs[0, 1].imshow(bundle.images[max_sd_row])
+    axs[0, 1].set_title(f"Max sd expression: {stats['sd_expr'][max_sd_row]} at {tuple(coords[max_sd_row].tolist())} \n "
+                        f"Number of cells: {n_cells[max_sd_row]}")
+    axs[1, 0].hist(random_expr, bins=50)
+    axs[1, 0].set_title(f"Random patch expression distributions: avg expression {stats['avg_expr'][random_row]} at "
+                        f"{tuple(coords[random_row].tolist())} \n Number of cells: {n_cells[random_row]}")
+    axs[1, 0].set_xlabel('Expression value')
+    axs[1, 0].set_ylabel('Frequency')
+    axs[1, 1].hist(stats['avg_expr'], bins=50)
+    axs[1, 1].set_title(f"Avg expression across all {stats['n_patches']} patches")
+    axs[1, 1].set_xlabel('Expression value')
+    axs[1, 1].set_ylabel('Frequency')
+    fig.suptitle(f"Sample Expression Statistics and Visualization for {id}", fontsize=16)
+    fig.tight_layout(rect=[0, 0, 1, 0.95])
+    fig.savefig(osp.join(plot_dir, f"sample_expression_viz_{id}.png"))
+    plt.close(fig)
+
+def plot_bundle(bundle_path, plot_dir, level='full', seed=0):
+    '''
+    Input:
+    bundle_path: a processed slide
+    plot_dir: directory to save the figures
+    level: 'summary' plots the cell count distribution only, 'full' also the sampled patches and expression
+    seed: seed of the random patches that are shown
+
+    Output:
+    (bundle_path, error, seconds) where error is None on success and the formatted traceback otherwise
+    '''
+    start = time.perf_counter()
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        bundle = load_bundle(bundle_path)
+        id = bundle.meta.get('id', osp.basename(osp.normpath(bundle_path)))
+        os.makedirs(plot_dir, exist_ok=True)
+        if len(bundle) == 0:
+            return bundle_path, None, time.perf_counter() - start
+
+        stats = bundle_qc_stats(bundle, seed=seed)
+        plot_cell_counts(stats, id, plot_dir)
+        if level == 'full':
+            plot_sample_patches(stats, bundle, id, plot_dir)
+            plot_sample_expression(stats, bundle, id, plot_dir)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return bundle_path, error, time.perf_counter() - start
+
+def plot_bundles(jobs, level='full', workers=1, log=print):
+    '''
+    Input:
+    jobs: list of (bundle_path, plot_dir)
+    level: 'none', 'summary' or 'full', see plot_bundle
+    workers: number of processes rendering figures in parallel
+
+    Output:
+    failed: a dict that maps each bundle path whose figures failed to its traceback
+    '''
+    failed = dict()
+    if level == 'none' or not jobs:
+        return failed
+    if level not in PLOT_LEVELS:
+        raise ValueError(f"Unknown plot level: {level}")
+
+    start = time.perf_counter()
+    if workers <= 1:
+        results = [plot_bundle(bundle_path, plot_dir, level=level) for bundle_path, plot_dir in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as pool:
+            futures = [pool.submit(plot_bundle, bundle_path, plot_dir, level=level) for bundle_path, plot_dir in jobs]
+            results = [future.result() for future in as_completed(futures)]
+
+    for bundle_path, error, _ in results:
+        if error is not None:
+            failed[bundle_path] = error
+            log(f"QC plots failed for {bundle_path}\n{error}")
+    log(f"Rendered {level} QC plots of {len(jobs) - len(failed)} of {len(jobs)} slides in "
+        f"{time.perf_counter() - start:.1f}s with {workers} workers")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Render QC plots of processed slides")
+    parser.add_argument('--processed_dir', type=str, required=True,
+                        help="Output directory of squidp-process, or one of its patch_<size> folders")
+    parser.add_argument('--plot_dir', type=str, default=None, help="Defaults to PROCESSED_DIR/plots")
+    parser.add_argument('--plots', type=str, default='full', choices=PLOT_LEVELS[1:])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    processed_dir = auto_expand(args.processed_dir)
+    plot_dir = auto_expand(args.plot_dir) if args.plot_dir else osp.join(processed_dir, "plots")
+
+    # plots of a multi-scale run go to the same patch_<size> folders as its bundles
+    jobs = [(bundle_path, osp.normpath(osp.join(plot_dir, osp.relpath(osp.dirname(bundle_path), processed_dir))))
+            for bundle_path in find_processed_bundles(processed_dir)]
+    plot_bundles(jobs, level=args.plots, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
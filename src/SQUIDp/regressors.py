@@ -0,0 +1,172 @@
+# regressors from patch embeddings to expression, fit on all genes at once
+import numpy as np
+from typing import NamedTuple
+
+RIDGE_ALPHAS = (1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0)
+
+class RidgeStats(NamedTuple):
+    '''
+    Sufficient statistics of a (X, Y) sample for ridge regression, in float64.
+    Statistics of disjoint samples add up, so the training set of every fold
+    is the total minus the held-out part.
+
+    n: number of rows
+    sum_x: (d,), sum_y: (g,), sum_yy: (g,) sums of X, Y and Y**2
+    xx: (d, d) X^T X, xy: (d, g) X^T Y
+    '''
+    n: int
+    sum_x: np.ndarray
+    sum_y: np.ndarray
+    sum_yy: np.ndarray
+    xx: np.ndarray
+    xy: np.ndarray
+
+    def __add__(self, other):
+        return RidgeStats(*[a + b for a, b in zip(self, other)])
+
+    def __sub__(self, other):
+        return RidgeStats(*[a - b for a, b in zip(self, other)])
+
+def ridge_stats(X, Y, chunk_rows=16384):
+    """
+    RidgeStats of X (n, d) and Y (n, g), read in chunks of rows so memory-mapped
+    inputs are never loaded whole.
+    """
+    n, d = X.shape
+    g = Y.shape[1]
+    stats = RidgeStats(0, np.zeros(d), np.zeros(g), np.zeros(g), np.zeros((d, d)), np.zeros((d, g)))
+    for start in range(0, n, chunk_rows):
+        x = np.asarray(X[start:start + chunk_rows], dtype=np.float64)
+        y = np.asarray(Y[start:start + chunk_rows], dtype=np.float64)
+        stats = stats + RidgeStats(len(x), x.sum(axis=0), y.sum(axis=0), np.einsum('ij,ij->j', y, y), x.T @ x, x.T @ y)
+    return stats
+
+class RidgeModel(NamedTuple):
+    weights: np.ndarray  # (d, g)
+    bias: np.ndarray  # (g,)
+    alpha: np.ndarray  # (g,) penalty chosen for every gene
+
+    def predict(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.weights + self.bias
+
+def fit_ridge(stats, alphas=RIDGE_ALPHAS):
+    """
+    Closed-form ridge on centered data for every alpha, from one eigendecomposition
+    of the covariance. Penalties are relative to the mean eigenvalue, so the same
+    grid suits any embedding scale. Returns a list of RidgeModel, one per alpha.
+    """
+    n = max(stats.n, 1)
+    mean_x, mean_y = stats.sum_x / n, stats.sum_y / n
+    cov_xx = stats.xx - n * np.outer(mean_x, mean_x)
+    cov_xy = stats.xy - n * np.outer(mean_x, mean_y)
+    eigvals, eigvecs = np.linalg.eigh(cov_xx)
+    eigvals = np.maximum(eigvals, 0)
+    scale = eigvals.mean() if eigvals.mean() > 0 else 1.0
+    projected = eigvecs.T @ cov_xy
+
+    models = []
+    for alpha in alphas:
+        weights = eigvecs @ (projected / (eigvals + alpha * scale)[:, None])
+        models.append(RidgeModel(weights, mean_y - mean_x @ weights, np.full(len(mean_y), alpha, dtype=np.float64)))
+    return models
+
+def ridge_sse(model, stats):
+    """
+    Per-gene sum of squared errors of model on the sample summarized by stats,
+    without touching the sample itself.
+    """
+    W, b = model.weights, model.bias
+    # sum over rows of (y - xW - b)^2, expanded into the statistics
+    return (stats.sum_yy - 2 * np.einsum('dg,dg->g', W, stats.xy) + np.einsum('dg,dg->g', W, stats.xx @ W)
+            - 2 * b * stats.sum_y + 2 * b * (stats.sum_x @ W) + stats.n * np.square(b))
+
+def select_ridge(train_stats, val_stats, alphas=RIDGE_ALPHAS):
+    """
+    Picks the alpha of every gene by its error on val_stats after fitting on
+    train_stats, then refits on both. Returns a RidgeModel.
+    """
+    errors = np.stack([ridge_sse(model, val_stats) for model in fit_ridge(train_stats, alphas)])
+    best = np.argmin(errors, axis=0)
+    models = fit_ridge(train_stats + val_stats, alphas)
+    genes = np.arange(len(best))
+    weights = np.stack([model.weights for model in models])[best, :, genes].T
+    bias = np.stack([model.bias for model in models])[best, genes]
+    return RidgeModel(weights, bias, np.asarray(alphas, dtype=np.float64)[best])
+
+class MLPModel(NamedTuple):
+    net: object  # torch module
+    mean: np.ndarray
+    std: np.ndarray
+    epochs: int  # epoch of the weights kept by early stopping
+
+    def predict(self, X, batch_rows=65536):
+        import torch
+        out = []
+        with torch.inference_mode():
+            for start in range(0, len(X), batch_rows):
+                x = (np.asarray(X[start:start + batch_rows], dtype=np.float32) - self.mean) / self.std
+                out.append(self.net(torch.from_numpy(x)).numpy())
+        return np.concatenate(out) if out else np.empty((0, self.net[-2].out_features), dtype=np.float32)
+
+def fit_mlp(X_train, Y_train, X_val, Y_val, hidden_dim=512, lr=1e-3, weight_decay=0.0, batch_size=1024,
+            max_epochs=300, patience=20, seed=0, threads=None):
+    '''
+    Input:
+    X_train, Y_train: (n, d) embeddings and (n, g) expression to fit
+    X_val, Y_val: held-out rows whose MSE drives early stopping
+    hidden_dim: width of the hidden layer, the architecture of the eval notebooks
+    (Linear, ReLU, Linear, ReLU)
+    lr, weight_decay: Adam settings
+    batch_size: rows per step, None for full-batch steps
+    max_epochs: epoch budget
+    patience: epochs without a better validation MSE before stopping
+    seed: seed of the initial weights and batch order
+    threads: torch threads, e.g. the cpus over the number of parallel fits
+
+    Output:
+    an MLPModel with the weights of the best validation epoch
+    '''
+    import torch
+    import torch.nn as nn
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    # inputs standardized with the training statistics
+    X_train = np.asarray(X_train, dtype=np.float32)
+    mean = X_train.mean(axis=0)
+    std = X_train.std(axis=0) + 1e-6
+    x_train = torch.from_numpy((X_train - mean) / std)
+    y_train = torch.from_numpy(np.asarray(Y_train, dtype=np.float32))
+    x_val = torch.from_numpy((np.asarray(X_val, dtype=np.float32) - mean) / std)
+    y_val = torch.from_numpy(np.asarray(Y_val, dtype=np.float32))
+
+    net = nn.Sequential(nn.Linear(x_train.shape[1], hidden_dim), nn.ReLU(),
+                        nn.Linear(hidden_dim, y_train.shape[1]), nn.ReLU())
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr, weight_decay=weight_decay)
+    batch_size = batch_size or len(x_train)
+
+    best_loss, best_state, best_epoch = float('inf'), None, 0
+    for epoch in range(1, max_epochs + 1):
+        net.train()
+        order = rng.permutation(len(x_train)) if batch_size < len(x_train) else None
+        for start in range(0, len(x_train), batch_size):
+            rows = torch.from_numpy(order[start:start + batch_size]) if order is not None else slice(None)
+            optimizer.zero_grad()
+            loss = nn.functional.mse_loss(net(x_train[rows]), y_train[rows])
+            loss.backward()
+            optimizer.step()
+
+        net.eval()
+        with torch.inference_mode():
+            val_loss = nn.functional.mse_loss(net(x_val), y_val).item() if len(x_val) else loss.item()
+        if val_loss < best_loss:
+            best_loss, best_epoch = val_loss, epoch
+            best_state = {name: value.detach().clone() for name, value in net.state_dict().items()}
+        elif epoch - best_epoch >= patience:
+            break
+
+    net.load_state_dict(best_state)
+    net.eval()
+    return MLPModel(net, mean, std, best_epoch)
@@ -0,0 +1,82 @@
+# reads only what processing uses from a downloaded HEST sample, see load_slide
+import os.path as osp
+import json
+import time
+import numpy as np
+from SQUIDp.util import sample_files
+from SQUIDp.profiling import current_rss_mb
+
+class HESTSlide:
+    """
+    The parts of a HESTData object the pipeline reads: .meta, .wsi and
+    to_spatial_data(), whose 'locations' hold the cell centroids as plain
+    x / y columns (indexed by cell id) instead of shapely points, and whose
+    'table' is the expression AnnData.
+    """
+    def __init__(self, meta, wsi, table, x, y, cell_ids):
+        self.meta = meta
+        self.wsi = wsi
+        self.table = table
+        self.x = x
+        self.y = y
+        self.cell_ids = cell_ids
+        self.load_stats = dict()
+
+    def to_spatial_data(self):
+        import pandas as pd
+        geometry = pd.DataFrame({'x': self.x, 'y': self.y}, index=pd.Index(self.cell_ids))
+        return {'locations': {'geometry': geometry}, 'table': self.table}
+
+def _parquet_memory_bytes(path):
+    # uncompressed size from the parquet footer, close to what loading the table costs
+    try:
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(path).metadata
+        return sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+    except Exception:
+        return None
+
+def load_slide(hest_data_dir, id):
+    '''
+    Input:
+    hest_data_dir: directory to downloaded dataset
+    id: HEST sample id
+
+    Output:
+    slide: a HESTSlide with the metadata, a handle on the WSI (nothing is read
+    from it yet) and the cells x genes table from st/<id>.h5ad, whose
+    obsm['spatial'] holds the cell centroids at level 0. The transcripts and
+    segmentation shapes iter_hest also loads are never opened; slide.load_stats
+    records the load time, RSS growth and the size of the files left unread.
+    '''
+    import anndata as ad
+    from hest.wsi import wsi_factory
+
+    start, rss_start = time.perf_counter(), current_rss_mb()
+    with open(osp.join(hest_data_dir, "metadata", f"{id}.json"), 'r') as f:
+        meta = json.load(f)
+    meta.setdefault('id', id)
+
+    st_path = osp.join(hest_data_dir, "st", f"{id}.h5ad")
+    wsi_path = osp.join(hest_data_dir, "wsis", f"{id}.tif")
+    table = ad.read_h5ad(st_path)
+    spatial = np.asarray(table.obsm['spatial'], dtype=np.float64)
+    # the cell ids expression rows are looked up by, see expr_rows
+    if 'instance_id' not in table.obs:
+        table.obs['instance_id'] = np.arange(table.n_obs)
+    cell_ids = table.obs['instance_id'].to_numpy()
+    wsi = wsi_factory(wsi_path)
+
+    slide = HESTSlide(meta, wsi, table, spatial[:, 0], spatial[:, 1], cell_ids)
+    loaded = {osp.abspath(path) for path in [st_path, wsi_path]}
+    skipped = [path for path in sample_files(hest_data_dir, [id])[id]
+               if osp.abspath(path) not in loaded and not path.endswith(".json")]
+    memory_bytes = [_parquet_memory_bytes(path) for path in skipped if path.endswith(".parquet")]
+    slide.load_stats = {
+        'load_s': time.perf_counter() - start,
+        'rss_mb': current_rss_mb() - rss_start,
+        'skipped_files': len(skipped),
+        'skipped_disk_mb': sum(osp.getsize(path) for path in skipped) / 2**20,
+        'skipped_memory_mb': sum(size for size in memory_bytes if size) / 2**20,
+    }
+    return slide
@@ -1,7 +1,10 @@
 import os
 import os.path as osp
-import pandas as pd
-from typing import List
+import re
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, List, Optional
 
 def auto_expand(path):
     """
@@ -12,11 +15,64 @@ def auto_expand(path):
     return path
 
 def get_ids(meta_df,  tissues: List[str], 
-            species: str = 'Homo sapiens', st_technology: str = 'Xenium',):
+            species: str = 'Homo sapiens', st_technology: str = 'Xenium',
+            organs: Optional[List[str]] = None, oncotree_codes: Optional[List[str]] = None):
     """
-    Returns the sample ids according to the filter specified
+    Returns the sample ids according to the filter specified, a filter left
+    as None matches every sample. All filters are combined into one mask.
     """
-    meta_df = meta_df[meta_df['species'] == species]
-    meta_df = meta_df[meta_df['st_technology'] == st_technology]
-    meta_df = meta_df[meta_df['tissue'].isin(tissues)]
-    return meta_df['id'].values
\ No newline at end of file
+    filters = {'species': None if species is None else [species],
+               'st_technology': None if st_technology is None else [st_technology], 'tissue': tissues,
+               'organ': organs, 'oncotree_code': oncotree_codes}
+    mask = np.ones(len(meta_df), dtype=bool)
+    for column, values in filters.items():
+        if values is not None:
+            mask &= meta_df[column].isin(values).to_numpy()
+    return meta_df['id'].to_numpy()[mask]
+
+@contextmanager
+def atomic_open(path, mode='wb'):
+    """
+    Writes to a temporary file next to path and moves it into place only once
+    the block finishes, so a crash never leaves a truncated file behind.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def sample_files(data_dir, ids) -> Dict[str, List[str]]:
+    """
+    Returns the files under data_dir that belong to each sample id, matched the
+    same way as the HEST download patterns (the id followed by '_' or '.').
+    """
+    ids = list(ids)
+    files = {id: [] for id in ids}
+    if not ids:
+        return files
+    pattern = re.compile("^(" + "|".join(re.escape(id) for id in ids) + ")[_.]")
+    for root, _, names in os.walk(data_dir):
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                files[match.group(1)].append(osp.join(root, name))
+    return files
+
+def fingerprint(paths, root=None) -> str:
+    """
+    Returns a hash of the relative path, size and mtime of each file, cheap
+    enough to tell whether the inputs changed without reading them.
+    """
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        name = osp.relpath(path, root) if root else path
+        h.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()